@@ -0,0 +1,210 @@
+"""analytics.py - Offline analysis of finished Games, to check the difficulty
+parameters (get_attempts_allowed and get_word_length) against real play.
+
+The /tasks/analyze_games job reads the Scores that score compaction has not
+touched yet (dated since the run's since date) in large cursor batches
+together with their Games, turns each batch into column arrays and aggregates them
+per difficulty and word length with NumPy.  Batch totals are additive, so
+they are kept in the 'running' AnalyticsSummary between tasks; when the scan
+is done the summary rows are computed once and stored as 'latest', which
+/admin/analytics returns without rescanning."""
+
+from datetime import datetime
+
+from google.appengine.ext import ndb
+
+from models import GameDifficulty
+
+DIFFICULTIES = sorted(
+    GameDifficulty.names(),
+    key=lambda name: GameDifficulty.lookup_by_name(name).number)
+# Histograms have one bucket per count; larger counts go in the last bucket
+MAX_COUNT = 30
+
+
+class AnalyticsSummary(ndb.Model):
+    """Totals per difficulty and word length of finished Games.  The entity
+    with id 'running' accumulates the totals of the run in progress; 'latest'
+    holds the rows of the last complete run.  Only Scores dated since are
+    read: older losing Scores were folded into DailyScoreAggregates, and
+    counting only the wins kept among them would inflate the win rates."""
+    started = ndb.DateTimeProperty(required=True)
+    finished = ndb.DateTimeProperty()
+    since = ndb.DateProperty()
+    scores = ndb.IntegerProperty(required=True, default=0)
+    skipped = ndb.IntegerProperty(required=True, default=0)
+    # {'DIFFICULTY:word_length': {'games', 'wins', 'guesses',
+    #  'attempts_remaining'}}, the last two being histograms
+    totals = ndb.JsonProperty(compressed=True)
+    rows = ndb.JsonProperty(compressed=True)
+
+    @classmethod
+    def start(cls, since):
+        """Starts a new run of the Scores dated since, discarding the totals
+        of an unfinished one.  The tasks of a run pass run_id() along, so
+        that the tasks of a discarded run can tell they are stale."""
+        run = cls(id='running', started=datetime.now(), since=since,
+                  totals={})
+        run.put()
+        return run
+
+    def run_id(self):
+        """Returns the id of the run, from the time it started"""
+        return self.started.isoformat()
+
+    @classmethod
+    def get_running(cls, run_id):
+        """Returns the running AnalyticsSummary if its id is run_id, or
+        None"""
+        run = cls.get_by_id('running')
+        if run is None or run.run_id() != run_id:
+            return None
+        return run
+
+    @ndb.transactional
+    def save(self):
+        """Stores the totals of the run, unless another run was started
+        meanwhile.  Returns False if one was."""
+        if self.get_running(self.run_id()) is None:
+            return False
+        self.put()
+        return True
+
+    def add_scores(self, scores):
+        """Adds a batch of Scores to the totals.  Their Games are fetched
+        with one batch get.  Scores of Games that were canceled or expired,
+        or no longer exist, are counted as skipped."""
+        games = ndb.get_multi([score.game for score in scores])
+        columns, skipped = _columns(scores, games)
+        self.scores += len(scores)
+        self.skipped += skipped
+        if columns['won']:
+            _merge(self.totals, _aggregate(columns))
+
+    def finish(self):
+        """Computes the summary rows and stores them as the latest run,
+        unless another run was started meanwhile.  Returns the latest
+        AnalyticsSummary, or None if another run was started."""
+        latest = AnalyticsSummary(id='latest', started=self.started,
+                                  finished=datetime.now(), since=self.since,
+                                  scores=self.scores,
+                                  skipped=self.skipped,
+                                  rows=_summarize(self.totals))
+
+        @ndb.transactional(xg=True)
+        def _finish():
+            if self.get_running(self.run_id()) is None:
+                return None
+            latest.put()
+            self.key.delete()
+            return latest
+        return _finish()
+
+    def to_dict(self):
+        return {'started': str(self.started),
+                'finished': str(self.finished) if self.finished else None,
+                'since': str(self.since) if self.since else None,
+                'scores': self.scores,
+                'skipped': self.skipped,
+                'rows': self.rows}
+
+
+def _columns(scores, games):
+    """Returns the columns of a batch of Scores and their Games as lists,
+    and the number of Scores skipped"""
+    columns = dict((name, []) for name in
+                   ('difficulty', 'word_length', 'won', 'guesses',
+                    'attempts_remaining'))
+    skipped = 0
+    for score, game in zip(scores, games):
+        if game is not None:
+            # Games saved before moves existed only record the ending in
+            # their history
+            game._ensure_moves()
+        if game is None or game.ending:
+            skipped += 1
+            continue
+        columns['difficulty'].append(DIFFICULTIES.index(score.difficulty))
+        columns['word_length'].append(len(game.word))
+        columns['won'].append(1 if score.won else 0)
+        columns['guesses'].append(len(game.guesses))
+        columns['attempts_remaining'].append(game.attempts_remaining)
+    return columns, skipped
+
+
+def _aggregate(columns):
+    """Returns the totals of a batch of columns, grouped by difficulty and
+    word length"""
+    # Imported here so that other requests do not pay for loading NumPy
+    import numpy
+
+    difficulty = numpy.array(columns['difficulty'], dtype=numpy.int32)
+    word_length = numpy.array(columns['word_length'], dtype=numpy.int32)
+    won = numpy.array(columns['won'], dtype=numpy.int32)
+    stride = int(word_length.max()) + 1
+    groups, group = numpy.unique(difficulty * stride + word_length,
+                                 return_inverse=True)
+    games = numpy.bincount(group, minlength=len(groups))
+    wins = numpy.bincount(group, weights=won, minlength=len(groups))
+    histograms = {}
+    for name in ('guesses', 'attempts_remaining'):
+        values = numpy.minimum(numpy.array(columns[name], dtype=numpy.int32),
+                               MAX_COUNT)
+        histograms[name] = numpy.bincount(
+            group * (MAX_COUNT + 1) + values,
+            minlength=len(groups) * (MAX_COUNT + 1)).reshape(
+                len(groups), MAX_COUNT + 1)
+
+    totals = {}
+    for i, value in enumerate(groups):
+        key = '{}:{}'.format(DIFFICULTIES[value // stride], value % stride)
+        totals[key] = {'games': int(games[i]),
+                       'wins': int(wins[i]),
+                       'guesses': histograms['guesses'][i].tolist(),
+                       'attempts_remaining':
+                           histograms['attempts_remaining'][i].tolist()}
+    return totals
+
+
+def _merge(totals, batch):
+    """Adds the totals of a batch to totals"""
+    for key, group in batch.iteritems():
+        if key not in totals:
+            totals[key] = group
+            continue
+        total = totals[key]
+        total['games'] += group['games']
+        total['wins'] += group['wins']
+        for name in ('guesses', 'attempts_remaining'):
+            total[name] = [a + b for a, b in zip(total[name], group[name])]
+
+
+def _summarize(totals):
+    """Returns a row per difficulty and word length, with the win rate and
+    the mean, median and 90th percentile of guesses used and attempts
+    remaining"""
+    import numpy
+
+    rows = []
+    for key, total in totals.iteritems():
+        difficulty, word_length = key.split(':')
+        row = {'difficulty': difficulty,
+               'word_length': int(word_length),
+               'games': total['games'],
+               'wins': total['wins'],
+               'win_rate': round(float(total['wins']) / total['games'], 4)}
+        for name in ('guesses', 'attempts_remaining'):
+            histogram = numpy.array(total[name])
+            cumulative = numpy.cumsum(histogram)
+            row[name + '_mean'] = round(
+                float(numpy.dot(histogram, numpy.arange(len(histogram)))) /
+                total['games'], 2)
+            row[name + '_p50'] = int(numpy.searchsorted(
+                cumulative, 0.5 * total['games']))
+            row[name + '_p90'] = int(numpy.searchsorted(
+                cumulative, 0.9 * total['games']))
+            row[name + '_histogram'] = total[name]
+        rows.append(row)
+    rows.sort(key=lambda row: (DIFFICULTIES.index(row['difficulty']),
+                               row['word_length']))
+    return rows
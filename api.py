@@ -1,34 +1,76 @@
-import logging
+import time
+IMPORT_START = time.time()
+
 import endpoints
-from protorpc import remote, messages
+from protorpc import remote, messages, protojson
 from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
 from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
 
-from models import User, Game, Score
+import counters
+import instrumentation
+from models import User, Game, Score, UserStats, Leaderboard
 from models import StringMessage, NewGameForm, GameForm, GameForms,\
-    MakeMoveForm, ScoreForm, ScoreForms, RankingForm, RankingForms,\
-    HistoryForm
-from models import GameDifficulty
-from utils import get_by_urlsafe
+    MakeMoveForm, ScoreForms, RankingForms,\
+    HistoryForm, MakeMovesForm, MoveResultForm, MovesForm, NewGamesForm,\
+    GameKeysForm, HintForm
+from models import LEADERBOARD_SIZE
+from models import MEMCACHE_GAME_FORM, MEMCACHE_GAME_HISTORY
+from utils import get_key_by_urlsafe
+from utils import get_cursor
+from utils import get_next_cursor
+from utils import validatePageSize
+from utils import validateUserName
 from utils import validateGameDifficultyValue
 from utils import validateEmail
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
+NEW_GAMES_REQUEST = endpoints.ResourceContainer(NewGamesForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1),
     email=messages.StringField(2))
 HIGH_SCORES_REQUEST = endpoints.ResourceContainer(
     number_of_results=messages.IntegerField(1, default=10),
     difficulty=messages.StringField(2, required=True))
+USER_GAMES_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2, default=20),
+    cursor=messages.StringField(3),
+    active_only=messages.BooleanField(4, default=False))
+SCORES_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1, default=20),
+    cursor=messages.StringField(2),
+    difficulty=messages.StringField(3))
+USER_SCORES_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2, default=20),
+    cursor=messages.StringField(3),
+    difficulty=messages.StringField(4))
 RANKINGS_REQUEST = endpoints.ResourceContainer(
-    difficulty=messages.StringField(1))
-
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+    difficulty=messages.StringField(1),
+    page_size=messages.IntegerField(2, default=20),
+    cursor=messages.StringField(3))
+
+MEMCACHE_MOVES_REMAINING_SCHEDULED = 'MOVES_REMAINING_SCHEDULED_{}'
+# Most games created by one new_games request
+MAX_GAMES_PER_REQUEST = 5000
+# Most guesses accepted by one make_moves request
+MAX_MOVES_PER_REQUEST = 50
+# Seconds covered by one coalesced cache_average_attempts task
+AVERAGE_ATTEMPTS_INTERVAL = 60
+# Seconds cached Game responses are kept.  Finished Games never change;
+# active Games are also invalidated whenever they are written.
+FINISHED_GAME_CACHE_TIME = 7 * 24 * 60 * 60
+ACTIVE_GAME_CACHE_TIME = 60
 
 @endpoints.api(name='hangman', version='v1')
 class HangmanApi(remote.Service):
@@ -42,9 +84,6 @@ class HangmanApi(remote.Service):
                       http_method='POST')
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
-            raise endpoints.ConflictException(
-                    'A User with that name already exists!')
         # Validate request.user_name is alphanumeric
         if not str(request.user_name).isalnum():
             raise endpoints.BadRequestException(
@@ -57,8 +96,9 @@ class HangmanApi(remote.Service):
             if not validateEmail(email):
                 raise endpoints.BadRequestException(
                     'The given email is invalid!')
-        user = User(name=request.user_name, email=email)
-        user.put()
+        if not User.create(request.user_name, email):
+            raise endpoints.ConflictException(
+                    'A User with that name already exists!')
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -71,23 +111,70 @@ class HangmanApi(remote.Service):
                       http_method='POST')
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
+        user_name = validateUserName(request.user_name)
+        difficulty = validateGameDifficultyValue(request)
+        return self._new_game_async(user_name, difficulty).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def _new_game_async(user_name, difficulty):
+        """Creates a new game and returns a Future of its GameForm.  The
+        User is resolved while the word is drawn, and the counter update
+        and average attempts task run concurrently."""
+        user, game = yield (User.get_by_name_async(user_name),
+                            Game._build_async(None, difficulty))
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-
-        difficulty = validateGameDifficultyValue(request)
-        if len(difficulty) > 0:
-            game = Game.new_game(user.key, difficulty)
-        else:
-            game = Game.new_game(user.key)
+        game.user = user.key
+        yield game.put_async()
 
         # Use a task queue to update the average attempts remaining.
         # This operation is not needed to complete the creation of a new game
         # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
+        yield (counters.increment_async({counters.ACTIVE_GAMES: 1,
+                                         counters.ATTEMPTS_REMAINING:
+                                             game.attempts_remaining}),
+               HangmanApi._schedule_cache_average_attempts_async())
+
+        raise ndb.Return(game.to_form(
+            'Good luck playing! Take a guess, letter or word!', user))
 
-        return game.to_form('Good luck playing! Take a guess, letter or word!')
+
+    @endpoints.method(request_message=NEW_GAMES_REQUEST,
+                      response_message=GameKeysForm,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    def new_games(self, request):
+        """Creates a new game for each of the given users, for example to
+        start a tournament round.  Returns the keys of the games, in the
+        order of user_names"""
+        if not request.user_names:
+            raise endpoints.BadRequestException(
+                    'The request is missing user_names!')
+        if len(request.user_names) > MAX_GAMES_PER_REQUEST:
+            raise endpoints.BadRequestException(
+                    'At most {} games can be created at once'.format(
+                        MAX_GAMES_PER_REQUEST))
+        user_names = [validateUserName(name) for name in request.user_names]
+        difficulty = validateGameDifficultyValue(request)
+
+        games, missing = Game.new_games(user_names, difficulty)
+        if missing:
+            raise endpoints.NotFoundException(
+                    'Users with these names do not exist: {}'.format(
+                        ', '.join(missing)))
+
+        counters.increment({counters.ACTIVE_GAMES: len(games),
+                            counters.ATTEMPTS_REMAINING:
+                                sum(game.attempts_remaining
+                                    for game in games)})
+        # One aggregate update for the whole batch
+        self._schedule_cache_average_attempts()
+
+        return GameKeysForm(urlsafe_keys=[game.key.urlsafe()
+                                          for game in games])
 
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
@@ -97,30 +184,56 @@ class HangmanApi(remote.Service):
                       http_method='GET')
     def get_game(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
+        def build(game):
             if game.game_over:
                 return game.to_form('Game is over.')
             else:
                 return game.to_form('Make a move!')
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+        return self._cached_game_response(
+            request.urlsafe_game_key, MEMCACHE_GAME_FORM, GameForm, build)
 
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=GameForms,
                       path='user/{user_name}/games',
                       name='get_user_games',
                       http_method='GET')
     def get_user_games(self, request):
-        """Returns all the requested User's games"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns a page of the requested User's games, optionally only
+        the active ones"""
+        page_size = validatePageSize(request.page_size)
+
+        def query(user_key):
+            games = Game.query(Game.user == user_key)
+            if request.active_only:
+                games = games.filter(Game.game_over == False)
+            return games
+        games, cursor, more = self._user_page_async(
+            request.user_name, query, page_size,
+            get_cursor(request.cursor)).get_result()
+        # The User is in the context cache; this costs no RPC
+        forms = Game.to_forms(games)
+        forms.next_cursor = get_next_cursor(cursor, more)
+        return forms
+
+    @staticmethod
+    @ndb.tasklet
+    def _user_page_async(user_name, query, page_size, cursor):
+        """Returns a Future of the page (results, cursor, more) of
+        query(user_key) for the named User.  The page is fetched with the
+        key the name maps to while the User is looked up, and fetched again
+        only for a User not keyed by name yet."""
+        user_key = User.key_for_name(validateUserName(user_name))
+        user, page = yield (User.get_by_name_async(user_name),
+                            query(user_key).fetch_page_async(
+                                page_size, start_cursor=cursor))
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-
-        games = Game.query(Game.user == user.key)
-        return GameForms(items=[game.to_form() for game in games])
+        if user.key != user_key:
+            page = yield query(user.key).fetch_page_async(
+                page_size, start_cursor=cursor)
+        raise ndb.Return(page)
 
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
@@ -130,16 +243,9 @@ class HangmanApi(remote.Service):
                       http_method='POST')
     def cancel_game(self, request):
         """Cancel an active game"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            if game.game_over:
-                return game.to_form('Game is over. Cannot cancel game.')
-            else:
-                game.history.append('Game canceled!')
-                game.end_game(False)
-                return game.to_form('Game canceled!')
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+        result = self._game_transaction(
+            Game.cancel, get_key_by_urlsafe(request.urlsafe_game_key, Game))
+        return self._move_response(*result)
 
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
@@ -149,54 +255,94 @@ class HangmanApi(remote.Service):
                       http_method='PUT')
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game.game_over:
-            return game.to_form('Game already over!')
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        guess = self._validate_guess(getattr(request, 'guess'))
+
+        # The Game is read, updated and written in one transaction
+        result = self._game_transaction(Game.make_move, game_key, guess)
+        return self._move_response(*result)
+
+
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MovesForm,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    def make_moves(self, request):
+        """Makes several moves in order, stopping when the game ends.
+        Returns the result of each move and the final game state"""
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        if not request.guesses:
+            raise endpoints.BadRequestException('The request is missing guesses!')
+        if len(request.guesses) > MAX_MOVES_PER_REQUEST:
+            raise endpoints.BadRequestException(
+                'At most {} guesses can be made at once'.format(
+                    MAX_MOVES_PER_REQUEST))
+        guesses = [self._validate_guess(guess) for guess in request.guesses]
+
+        # The Game is read and written once, in one transaction
+        result = self._game_transaction(Game.make_moves, game_key, guesses)
+        game, messages, history, attempts_remaining, was_active = result
+        return MovesForm(
+            game=self._move_response(game, messages[-1], attempts_remaining,
+                                     was_active),
+            results=[MoveResultForm(guess=guess, message=message)
+                     for guess, message in zip(guesses, messages)],
+            history=history)
+
+
+    @staticmethod
+    def _game_transaction(method, game_key, *args):
+        """Returns the result of a transactional Game method.  Raises a
+        NotFoundException if the Game does not exist, and a
+        ConflictException if concurrent writes to the Game made every
+        attempt of the transaction fail."""
+        try:
+            result = method(game_key, *args)
+        except datastore_errors.TransactionFailedError:
+            raise endpoints.ConflictException(
+                'The game was changed by another request, please retry!')
+        if not result:
+            raise endpoints.NotFoundException('Game not found!')
+        return result
+
+
+    @staticmethod
+    def _validate_guess(guess):
+        """Returns a guess from a request in upper case.  Raises a
+        BadRequestException if it is missing or not alphabetic."""
         # Check to see if guess is in the request
-        if getattr(request, 'guess') in (None, []):
+        if guess in (None, []):
             raise endpoints.BadRequestException('The request is missing a guess!')
-        if len(request.guess) < 1:
+        if len(guess) < 1:
             raise endpoints.BadRequestException('The guess is missing a value')
         # Check that user has entered a guess with only letters?
-        if not request.guess.isalpha():
+        if not guess.isalpha():
             raise endpoints.BadRequestException('The guess contains non-alphabet characters')
         # Request checks out, extract value
-        guess = str(request.guess).upper()
-
-        # Check the user, has not already guessed this letter or word
-        if guess in game.guesses:
-            # Return with a message, so client gets 200 status
-            return game.to_form('You have already guessed this value.  Try something else!')
-        # All checks out, add the guess to the guesses repeatable
-        game.guesses.append(guess)
-        msg = game.get_guess_status()
-        # If guess.length > 1, then user guessed a word
-        # Check if guess matches word
-        if len(guess) > 1:
-            if guess == game.word:
-                game.end_game(True)
-                return game.to_form('You win! Word is: ' + game.word)
-            else:
-                game.attempts_remaining -= 1
-                msg += ' Incorrect Guess!'
-        else: # User Guessed a single letter
-            if msg == game.word:
-                game.end_game(True)
-                return game.to_form('You win! Word is: ' + msg )
-            else:
-                if not game.is_guess_correct(guess):
-                    game.attempts_remaining -= 1
-                    msg += ' Incorrect Guess!'
-
-        if game.attempts_remaining < 1:
-            msg = msg + ' Game over! The word was ' + game.word
-            game.history.append('guess:' + guess + ', result:' + msg)
-            game.end_game(False)
+        return str(guess).upper()
+
+
+    @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='get_hint',
+                      http_method='GET')
+    def get_hint(self, request):
+        """Suggests the letter to guess next: the one found in the most
+        words of the word bank that match the game's guess status"""
+        game = get_key_by_urlsafe(request.urlsafe_game_key, Game).get()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            raise endpoints.BadRequestException('Game already over!')
+        letter, candidates = game.get_hint()
+        if candidates:
+            message = 'Try {}; {} possible words'.format(letter, candidates)
         else:
-            msg = msg + ' Keep Going!'
-            game.history.append('guess:' + guess + ', result:' + msg)
-            game.put()
-        return game.to_form(msg)
+            message = 'Try {}'.format(letter)
+        return HintForm(letter=letter, candidates=candidates,
+                        message=message)
 
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
@@ -206,32 +352,76 @@ class HangmanApi(remote.Service):
                       http_method='GET')
     def get_game_history(self, request):
         """Returns the Game's History"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        return HistoryForm(history=[history for history in game.history])
+        def build(game):
+            return HistoryForm(history=game.get_history(), etag=game.etag())
+        return self._cached_game_response(
+            request.urlsafe_game_key, MEMCACHE_GAME_HISTORY, HistoryForm,
+            build)
+
+    @staticmethod
+    def _cached_game_response(urlsafe_game_key, cache_key, message_type,
+                              build):
+        """Returns the response for a Game from memcache, where it is kept
+        serialized, or builds it with build(game) and caches it"""
+        game_key = get_key_by_urlsafe(urlsafe_game_key, Game)
+        cache_key = cache_key.format(game_key.urlsafe())
+        cached = memcache.get(cache_key)
+        if cached is not None:
+            return protojson.decode_message(message_type, cached)
+        game = game_key.get()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        response = build(game)
+        memcache.set(cache_key, protojson.encode_message(response),
+                     time=FINISHED_GAME_CACHE_TIME if game.game_over
+                     else ACTIVE_GAME_CACHE_TIME)
+        return response
 
 
 # ========== SCORES (SPECIFIC USER) ENDPOINT API METHODS ==========
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=SCORES_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
-
-    @endpoints.method(request_message=USER_REQUEST,
+        """Return a page of scores, most recent first, optionally of one
+        GameDifficulty"""
+        scores, cursor, more = self._score_query(
+            Score.query(), request).fetch_page(
+                validatePageSize(request.page_size),
+                start_cursor=get_cursor(request.cursor))
+        forms = Score.to_forms(scores)
+        forms.next_cursor = get_next_cursor(cursor, more)
+        return forms
+
+    @endpoints.method(request_message=USER_SCORES_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                    'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        """Returns a page of an individual User's scores, most recent
+        first, optionally of one GameDifficulty"""
+        page_size = validatePageSize(request.page_size)
+        scores, cursor, more = self._user_page_async(
+            request.user_name,
+            lambda user_key: self._score_query(
+                Score.query(Score.user == user_key), request),
+            page_size, get_cursor(request.cursor)).get_result()
+        # The User is in the context cache; this costs no RPC
+        forms = Score.to_forms(scores)
+        forms.next_cursor = get_next_cursor(cursor, more)
+        return forms
+
+    @staticmethod
+    def _score_query(scores, request):
+        """Returns a Score query filtered by the request's difficulty, most
+        recent first"""
+        if request.difficulty:
+            scores = scores.filter(
+                Score.difficulty == validateGameDifficultyValue(request))
+        return scores.order(-Score.date, Score.key)
 
 
 # ========== SCORES (GENERAL POPULATION ENDPOINT API METHODS ==========
@@ -247,7 +437,15 @@ class HangmanApi(remote.Service):
         then the most recent
         """
         difficulty = validateGameDifficultyValue(request, True)
-        type(request)
+        # Validate number_of_results is a positive integer
+        number_of_results = int(request.number_of_results)
+        if number_of_results < 1:
+            raise endpoints.BadRequestException(
+                'Number of results must be a positive value')
+        # The cached leaderboard holds the best LEADERBOARD_SIZE wins
+        if number_of_results <= LEADERBOARD_SIZE:
+            return Leaderboard.get_leaderboard(difficulty).to_forms(
+                difficulty, number_of_results)
         scores = Score.query()
         scores = scores.order(Score.guesses)
         scores = scores.order(-Score.date)
@@ -255,12 +453,8 @@ class HangmanApi(remote.Service):
         scores = scores.filter(Score.difficulty == difficulty,\
             Score.won == True)
         # Get only the limit of results requested
-        # Validate number_of_results is a positive integer
-        if int(request.number_of_results) < 1:
-            raise endpoints.BadRequestException(
-                'Number of results must be a positive value')
-        scores = scores.fetch(int(request.number_of_results))
-        return ScoreForms(items=[score.to_form() for score in scores])
+        scores = scores.fetch(number_of_results)
+        return Score.to_forms(scores)
 
 
     @endpoints.method(request_message=RANKINGS_REQUEST,
@@ -270,36 +464,20 @@ class HangmanApi(remote.Service):
                       http_method='GET')
     def get_user_rankings(self, request):
         """
-        Returns all user rankings given a GameDifficulty level,
+        Returns a page of user rankings given a GameDifficulty level,
         Determined first by winning percentage then by number
-        if total wins as the tie breaker.
+        if total wins as the tie breaker.  Pass next_cursor back as
+        cursor to get the following page.
         """
         difficulty = validateGameDifficultyValue(request, True)
-        users = User.query().fetch()
-        items = []
-        total_games = 0
-        wins = 0
-        for user in users:
-            scores = Score.query()
-            # Filter by game difficulty and only wons that resulted in a win
-            scores = scores.filter(Score.user == user.key, \
-                Score.difficulty == difficulty)
-            scores.fetch()
-
-            for score in scores:
-                total_games += 1
-                if score.won:
-                    wins += 1
-            if total_games > 0:
-                items.append(
-                    RankingForm(user_name=user.name,
-                        difficulty=getattr(GameDifficulty, difficulty),
-                        win_percentage=round(float(wins)/total_games*100, 2),
-                        wins=wins)
-                            )
-            total_games = 0
-            wins = 0
-        return RankingForms(items=items)
+        page_size = validatePageSize(request.page_size)
+        stats = UserStats.query(UserStats.difficulty == difficulty)
+        stats = stats.order(-UserStats.win_percentage, -UserStats.wins)
+        stats, cursor, more = stats.fetch_page(
+            page_size, start_cursor=get_cursor(request.cursor))
+        return RankingForms(
+            items=[user_stats.to_form() for user_stats in stats],
+            next_cursor=get_next_cursor(cursor, more))
 
 
     @endpoints.method(response_message=StringMessage,
@@ -308,20 +486,77 @@ class HangmanApi(remote.Service):
                       http_method='GET')
     def get_average_attempts(self, request):
         """Get the cached average moves remaining"""
-        return StringMessage(message=memcache.get(MEMCACHE_MOVES_REMAINING) or '')
+        message = memcache.get(counters.MEMCACHE_MOVES_REMAINING)
+        if message is None:
+            message = counters.cache_average_attempts()
+        return StringMessage(message=message)
+
+
+    @staticmethod
+    def _schedule_cache_average_attempts():
+        """Schedules /tasks/cache_average_attempts to run at the end of the
+        current AVERAGE_ATTEMPTS_INTERVAL.  Requests in the same interval
+        share one named task."""
+        HangmanApi._schedule_cache_average_attempts_async().get_result()
+
+
+    @staticmethod
+    @ndb.tasklet
+    def _schedule_cache_average_attempts_async():
+        """Asynchronous version of _schedule_cache_average_attempts;
+        returns a Future"""
+        now = time.time()
+        bucket = int(now) // AVERAGE_ATTEMPTS_INTERVAL
+        # memcache add only succeeds once per bucket, which skips the
+        # taskqueue RPC for every other request in the interval
+        added = yield ndb.get_context().memcache_add(
+            MEMCACHE_MOVES_REMAINING_SCHEDULED.format(bucket), True,
+            time=AVERAGE_ATTEMPTS_INTERVAL * 2)
+        if not added:
+            return
+        try:
+            yield taskqueue.Queue().add_async(taskqueue.Task(
+                url='/tasks/cache_average_attempts',
+                name='cache-average-attempts-{}'.format(bucket),
+                countdown=(bucket + 1) * AVERAGE_ATTEMPTS_INTERVAL - now))
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+
+    @staticmethod
+    @ndb.tasklet
+    def _update_game_counters_async(game, attempts_remaining, was_active):
+        """Applies a move or the end of a Game to the active Game counters.
+        attempts_remaining and was_active are the Game's state before the
+        change; a Game that was already over changes nothing.  Returns a
+        Future; the counter update and the average attempts task run
+        concurrently."""
+        if not was_active:
+            return
+        if game.game_over:
+            deltas = {counters.ACTIVE_GAMES: -1,
+                      counters.ATTEMPTS_REMAINING: -attempts_remaining}
+        elif game.attempts_remaining != attempts_remaining:
+            deltas = {counters.ATTEMPTS_REMAINING:
+                          game.attempts_remaining - attempts_remaining}
+        else:
+            return
+        yield (counters.increment_async(deltas),
+               HangmanApi._schedule_cache_average_attempts_async())
 
 
     @staticmethod
-    def _cache_average_attempts():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                        for game in games])
-            average = float(total_attempts_remaining)/count
-            memcache.set(MEMCACHE_MOVES_REMAINING,
-                         'The average moves remaining is {:.2f}'.format(average))
-
-
-api = endpoints.api_server([HangmanApi])
+    def _move_response(game, message, attempts_remaining, was_active):
+        """Returns the GameForm of a Game after a move.  The counter update
+        runs after the Game's transaction has committed, concurrently with
+        building the form."""
+        future = HangmanApi._update_game_counters_async(
+            game, attempts_remaining, was_active)
+        form = game.to_form(message)
+        future.get_result()
+        return form
+
+
+api = instrumentation.middleware(endpoints.api_server([HangmanApi]))
+instrumentation.record_import_time(__name__, IMPORT_START)
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Local load test for the HangmanApi endpoints.
+
+Runs a weighted mix of endpoint calls against the App Engine testbed stubs
+(datastore, memcache, taskqueue, mail and urlfetch; words come from the
+bundled word bank) after seeding a configurable amount of data, and reports
+p50/p99 latency, datastore RPCs per call by type and entities read per call.
+
+Latency depends on the machine, but RPC and entity counts are deterministic
+for a given --seed (apart from the cache_average_attempts task, which is
+added once a minute), so a saved baseline in benchmarks/baselines/ shows
+query and batching regressions in review.
+
+Usage:
+    python benchmarks/benchmark.py --sdk ~/google_appengine \\
+        --scores 10000 --calls 2000 --save-baseline scores-10k
+    python benchmarks/benchmark.py --sdk ~/google_appengine \\
+        --scores 10000 --calls 2000 --baseline scores-10k
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'baselines')
+
+DEFAULT_MIX = ('create_user=1,new_game=2,make_move=12,get_high_scores=3,'
+               'get_user_rankings=2,send_reminder=0.02')
+DIFFICULTIES = ['EASY', 'NORMAL', 'HARD', 'EXPERT']
+LETTERS = 'ETAOINSHRDLCUMWFGYPBVKJXQZ'
+
+# A result is flagged when it is this much worse than the baseline
+LATENCY_REGRESSION = 1.5
+COUNT_REGRESSION = 0.10
+
+
+def setup_environment(sdk):
+    """Puts the App Engine SDK and the application on sys.path"""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT_DIR)
+    os.environ['HANGMAN_REMOTE_WORDS'] = ''
+
+
+class RpcRecorder(object):
+    """Counts the API calls made between reset() calls, and the number of
+    entities they return"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = collections.Counter()
+        self.entities_read = 0
+
+    def install(self, apiproxy):
+        apiproxy.GetPostCallHooks().Append('benchmark', self._post_call)
+
+    def _post_call(self, service, call, request, response):
+        self.calls['{}.{}'.format(service, call)] += 1
+        if service != 'datastore_v3':
+            return
+        if call == 'Get':
+            self.entities_read += sum(1 for entity in response.entity_list()
+                                      if entity.has_entity())
+        elif call in ('RunQuery', 'Next'):
+            self.entities_read += response.result_size()
+
+
+class Benchmark(object):
+    """Seeds the stubs and runs the workload"""
+
+    def __init__(self, args):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import ndb
+        from google.appengine.ext import testbed
+        self.args = args
+        self.random = random.Random(args.seed)
+        random.seed(args.seed)
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # Endpoints reads the app revision from the minor version
+        self.testbed.setup_env(current_version_id='testbed.1',
+                               overwrite=True)
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.
+            PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT_DIR)
+        self.testbed.init_mail_stub()
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_user_stub()
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        self.ndb = ndb
+
+        from google.appengine.api import apiproxy_stub_map
+        self.recorder = RpcRecorder()
+        self.recorder.install(apiproxy_stub_map.apiproxy)
+
+        # main first: the task handlers must not pay for importing api
+        import main
+        import api
+        import instrumentation
+        self.import_ms = dict(instrumentation.IMPORT_MS)
+        self.api_module = api
+        self.main = main
+        self.service = api.HangmanApi()
+        self.user_names = []
+        self.active_games = []
+        self.results = collections.defaultdict(list)
+
+    def close(self):
+        self.testbed.deactivate()
+
+    # ========== SEEDING ==========
+    def seed(self):
+        """Creates the Users, finished Scores and active Games to run
+        against.  Scores are written directly, with matching UserStats."""
+        from datetime import date, timedelta
+        from models import User, Score, Game, UserStats
+        ndb = self.ndb
+        args = self.args
+        start = time.time()
+
+        users = [User(key=User.key_for_name('seed{}'.format(i)),
+                      name='seed{}'.format(i),
+                      email='seed{}@example.com'.format(i))
+                 for i in range(args.users)]
+        self._put_batches(users)
+        self.user_names = [user.name for user in users]
+
+        totals = collections.defaultdict(lambda: [0, 0])
+        batch = []
+        today = date.today()
+        for i in range(args.scores):
+            user = users[i % len(users)]
+            difficulty = self.random.choice(DIFFICULTIES)
+            won = self.random.random() < 0.5
+            batch.append(Score(
+                user=user.key, game=ndb.Key(Game, 'seed{}'.format(i)),
+                date=today - timedelta(days=self.random.randint(0, 365)),
+                won=won, guesses=self.random.randint(1, 9),
+                difficulty=difficulty))
+            stats = totals[(user.key, user.name, difficulty)]
+            stats[0] += 1
+            stats[1] += 1 if won else 0
+            if len(batch) == 500:
+                ndb.put_multi(batch)
+                batch = []
+        ndb.put_multi(batch)
+
+        user_stats = []
+        for (user_key, user_name, difficulty), (games, wins) in \
+                totals.iteritems():
+            stats = UserStats(key=UserStats.key_for(user_key, difficulty),
+                              user=user_key, user_name=user_name,
+                              difficulty=difficulty)
+            stats.set_totals(games, wins)
+            user_stats.append(stats)
+        self._put_batches(user_stats)
+
+        for _ in range(args.active_games):
+            self._new_game()
+        self.drain_tasks()
+        sys.stderr.write('Seeded {} users, {} scores, {} active games in '
+                         '{:.1f}s\n'.format(args.users, args.scores,
+                                            args.active_games,
+                                            time.time() - start))
+
+    def _put_batches(self, entities):
+        for i in range(0, len(entities), 500):
+            self.ndb.put_multi(entities[i:i + 500])
+
+    # ========== OPERATIONS ==========
+    def _request(self, container, **fields):
+        return container.combined_message_class(**fields)
+
+    def _new_game(self):
+        api = self.api_module
+        form = self.service.new_game(self._request(
+            api.NEW_GAME_REQUEST,
+            user_name=self.random.choice(self.user_names)))
+        self.active_games.append([form.urlsafe_key, list(LETTERS)])
+
+    def op_create_user(self):
+        name = 'user{}'.format(len(self.user_names))
+        self.service.create_user(self._request(
+            self.api_module.USER_REQUEST, user_name=name,
+            email='{}@example.com'.format(name)))
+        self.user_names.append(name)
+
+    def op_new_game(self):
+        self._new_game()
+
+    def op_make_move(self):
+        if not self.active_games:
+            self._new_game()
+        game = self.random.choice(self.active_games)
+        letters = game[1]
+        guess = letters.pop(self.random.randrange(min(len(letters), 8)))
+        form = self.service.make_move(self._request(
+            self.api_module.MAKE_MOVE_REQUEST, urlsafe_game_key=game[0],
+            guess=guess))
+        if form.game_over or not letters:
+            self.active_games.remove(game)
+
+    def op_get_high_scores(self):
+        self.service.get_high_scores(self._request(
+            self.api_module.HIGH_SCORES_REQUEST,
+            difficulty=self.random.choice(DIFFICULTIES), number_of_results=10))
+
+    def op_get_user_rankings(self):
+        self.service.get_user_rankings(self._request(
+            self.api_module.RANKINGS_REQUEST,
+            difficulty=self.random.choice(DIFFICULTIES)))
+
+    def op_send_reminder(self):
+        self._handle('GET', '/crons/send_reminder')
+        self.drain_tasks()
+
+    # ========== TASKS ==========
+    def _handle(self, method, url, body=None):
+        import webapp2
+        request = webapp2.Request.blank(url, POST=body)
+        request.method = method
+        response = request.get_response(self.main.app)
+        if response.status_int >= 400:
+            raise RuntimeError('{} {} returned {}'.format(
+                method, url, response.status))
+
+    def drain_tasks(self):
+        """Runs every queued task, including the tasks they queue"""
+        from google.appengine.ext import deferred
+        while True:
+            tasks = self.taskqueue_stub.get_filtered_tasks()
+            if not tasks:
+                return
+            self.taskqueue_stub.FlushQueue('default')
+            for task in tasks:
+                if task.url == '/_ah/queue/deferred':
+                    deferred.run(task.payload)
+                else:
+                    self._handle('POST', task.url, task.extract_params())
+
+    # ========== RUN ==========
+    def run(self, mix):
+        names = [name for name, _ in mix]
+        weights = [weight for _, weight in mix]
+        total = float(sum(weights))
+        for _ in range(self.args.calls):
+            point = self.random.random() * total
+            for name, weight in zip(names, weights):
+                point -= weight
+                if point < 0:
+                    break
+            # Tasks queued by earlier operations run first, as they would
+            # within moments in production, so send_reminder only counts
+            # its own tasks
+            self.drain_tasks()
+            self.ndb.get_context().clear_cache()
+            self.recorder.reset()
+            start = time.time()
+            getattr(self, 'op_' + name)()
+            # Finish the RPCs the operation left pending, such as the next
+            # batch of a query, so they are not counted for the next one
+            self.ndb.eventloop.run()
+            elapsed = time.time() - start
+            self.results[name].append(
+                (elapsed * 1000, dict(self.recorder.calls),
+                 self.recorder.entities_read))
+        self.drain_tasks()
+
+    def report(self):
+        """Returns the summary of every operation, by name"""
+        summary = {}
+        for name, samples in sorted(self.results.iteritems()):
+            latencies = sorted(sample[0] for sample in samples)
+            calls = collections.Counter()
+            for sample in samples:
+                calls.update(sample[1])
+            count = len(samples)
+            summary[name] = {
+                'calls': count,
+                'p50_ms': round(percentile(latencies, 50), 2),
+                'p99_ms': round(percentile(latencies, 99), 2),
+                'rpcs_per_call': dict(
+                    (rpc, round(float(n) / count, 2))
+                    for rpc, n in sorted(calls.iteritems())),
+                'entities_read_per_call': round(
+                    float(sum(sample[2] for sample in samples)) / count, 2),
+            }
+        return summary
+
+
+def percentile(values, pct):
+    """Returns the pct-th percentile of sorted values"""
+    if not values:
+        return 0.0
+    index = int(round((len(values) - 1) * pct / 100.0))
+    return values[index]
+
+
+def parse_mix(mix):
+    """Parses 'name=weight,...' into a list of (name, weight)"""
+    result = []
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        if not hasattr(Benchmark, 'op_' + name.strip()):
+            raise SystemExit('Unknown operation: {}'.format(name))
+        result.append((name.strip(), float(weight)))
+    return result
+
+
+def print_report(summary, out=sys.stdout):
+    out.write('{:<20} {:>6} {:>9} {:>9} {:>9} {:>9}  {}\n'.format(
+        'operation', 'calls', 'p50 ms', 'p99 ms', 'ds rpcs', 'ents read',
+        'rpcs per call'))
+    for name, result in sorted(summary.iteritems()):
+        rpcs = result['rpcs_per_call']
+        datastore_rpcs = sum(n for rpc, n in rpcs.iteritems()
+                             if rpc.startswith('datastore_v3.'))
+        out.write('{:<20} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}  {}\n'
+                  .format(name, result['calls'], result['p50_ms'],
+                          result['p99_ms'], datastore_rpcs,
+                          result['entities_read_per_call'],
+                          ', '.join('{}={}'.format(rpc, n)
+                                    for rpc, n in sorted(rpcs.iteritems()))))
+
+
+def compare(summary, baseline, out=sys.stdout):
+    """Writes the regressions against a baseline and returns their count"""
+    regressions = []
+    for name, result in sorted(summary.iteritems()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['p50_ms'] > base['p50_ms'] * LATENCY_REGRESSION:
+            regressions.append('{}: p50 {} ms (baseline {} ms)'.format(
+                name, result['p50_ms'], base['p50_ms']))
+        for rpc, count in sorted(result['rpcs_per_call'].iteritems()):
+            base_count = base['rpcs_per_call'].get(rpc, 0)
+            if count > base_count * (1 + COUNT_REGRESSION) + 0.01:
+                regressions.append('{}: {} {} per call (baseline {})'.format(
+                    name, rpc, count, base_count))
+        if result['entities_read_per_call'] > \
+                base['entities_read_per_call'] * (1 + COUNT_REGRESSION) + 0.01:
+            regressions.append('{}: {} entities read per call (baseline {})'
+                               .format(name, result['entities_read_per_call'],
+                                       base['entities_read_per_call']))
+    for regression in regressions:
+        out.write('REGRESSION {}\n'.format(regression))
+    return len(regressions)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('GAE_SDK'),
+                        help='path of the App Engine Python SDK '
+                             '(default: $GAE_SDK)')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--scores', type=int, default=1000,
+                        help='finished Scores to seed (1k to 1M)')
+    parser.add_argument('--active-games', type=int, default=200)
+    parser.add_argument('--calls', type=int, default=1000)
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='operation weights (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save-baseline', metavar='NAME',
+                        help='write the results to baselines/NAME.json')
+    parser.add_argument('--baseline', metavar='NAME',
+                        help='compare against baselines/NAME.json and exit '
+                             'with status 1 on regressions')
+    args = parser.parse_args(argv)
+    if not args.sdk:
+        parser.error('--sdk or $GAE_SDK is required')
+
+    setup_environment(args.sdk)
+    benchmark = Benchmark(args)
+    try:
+        benchmark.seed()
+        benchmark.run(parse_mix(args.mix))
+        summary = benchmark.report()
+    finally:
+        benchmark.close()
+    print_report(summary)
+    sys.stdout.write('import ms: {}\n'.format(', '.join(
+        '{}={}'.format(name, ms)
+        for name, ms in sorted(benchmark.import_ms.iteritems()))))
+
+    config = dict((key, getattr(args, key)) for key in
+                  ('users', 'scores', 'active_games', 'calls', 'mix', 'seed'))
+    if args.save_baseline:
+        if not os.path.isdir(BASELINE_DIR):
+            os.makedirs(BASELINE_DIR)
+        path = os.path.join(BASELINE_DIR, args.save_baseline + '.json')
+        with open(path, 'w') as f:
+            json.dump({'config': config, 'results': summary}, f, indent=2,
+                      separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+    if args.baseline:
+        with open(os.path.join(BASELINE_DIR, args.baseline + '.json')) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            sys.stderr.write('Warning: baseline was run with {}\n'.format(
+                baseline['config']))
+        if compare(summary, baseline['results']):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
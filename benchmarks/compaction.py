@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""compaction.py - Checks that score compaction does not change the game
+analysis.
+
+Seeds finished Games with Scores spread over the last year against the App
+Engine testbed stubs, runs /tasks/analyze_games, compacts the Scores with
+/crons/compact_scores and runs the analysis again.  Compaction folds the old
+losing Scores into DailyScoreAggregates and keeps the wins, so an analysis
+that read those old Scores would report higher win rates afterwards.  Checks
+that compaction folded Scores and that both runs report the same rows.
+
+Exits with status 1 if any check fails.
+
+Usage:
+    python benchmarks/compaction.py --sdk ~/google_appengine --games 2000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+
+from benchmark import DIFFICULTIES, LETTERS, Benchmark, setup_environment
+
+
+class CompactionCheck(Benchmark):
+    """Seeds finished Games and compares the analysis before and after
+    compaction"""
+
+    def seed(self):
+        from datetime import date, timedelta
+        from models import User, Game, Score
+        ndb = self.ndb
+        rng = self.random
+        users = [User(key=User.key_for_name('seed{}'.format(i)),
+                      name='seed{}'.format(i),
+                      email='seed{}@example.com'.format(i))
+                 for i in range(self.args.users)]
+        self._put_batches(users)
+        today = date.today()
+        for start in range(0, self.args.games, 250):
+            games = []
+            for i in range(start, min(start + 250, self.args.games)):
+                difficulty = rng.choice(DIFFICULTIES)
+                word = ''.join(rng.sample(LETTERS, rng.randint(4, 12)))
+                game = Game._with_word(users[i % len(users)].key,
+                                       difficulty, word)
+                game.guesses = rng.sample(LETTERS, rng.randint(1, 20))
+                game.attempts_remaining = rng.randint(
+                    0, game.attempts_allowed)
+                game.game_over = True
+                games.append(game)
+            ndb.put_multi(games)
+            ndb.put_multi([Score(
+                user=game.user, game=game.key,
+                date=today - timedelta(days=rng.randint(0, 365)),
+                won=rng.random() < 0.5, guesses=len(game.guesses),
+                difficulty=game.difficulty) for game in games])
+            ndb.get_context().clear_cache()
+
+    def analyze(self):
+        """Runs a complete analysis and returns its summary"""
+        import analytics
+        self._handle('GET', '/tasks/analyze_games')
+        self.drain_tasks()
+        self.ndb.get_context().clear_cache()
+        return analytics.AnalyticsSummary.get_by_id('latest').to_dict()
+
+    def compact(self):
+        """Compacts the Scores; returns the number of Scores it folded"""
+        from models import Score
+        before = Score.query().count()
+        self._handle('GET', '/crons/compact_scores')
+        self.drain_tasks()
+        return before - Score.query().count()
+
+    def check(self):
+        """Returns the list of failures"""
+        failures = []
+        uncompacted = self.analyze()
+        folded = self.compact()
+        compacted = self.analyze()
+        sys.stdout.write('{} games, {} scores analyzed, {} scores folded by '
+                         'compaction\n'.format(self.args.games,
+                                               uncompacted['scores'], folded))
+        if not folded:
+            failures.append('compaction folded no Scores')
+        if compacted['scores'] != uncompacted['scores']:
+            failures.append('{} scores analyzed after compaction, {} '
+                            'before'.format(compacted['scores'],
+                                            uncompacted['scores']))
+        key = lambda row: (row['difficulty'], row['word_length'])
+        rows = dict((key(row), row) for row in uncompacted['rows'])
+        for row in compacted['rows']:
+            if rows.pop(key(row), None) != row:
+                failures.append('{}:{} after compaction: {}'.format(
+                    row['difficulty'], row['word_length'],
+                    json.dumps(row, sort_keys=True)))
+        for difficulty, word_length in sorted(rows):
+            failures.append('{}:{} missing after compaction'.format(
+                difficulty, word_length))
+        return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('GAE_SDK'),
+                        help='path of the App Engine Python SDK '
+                             '(default: $GAE_SDK)')
+    parser.add_argument('--games', type=int, default=2000,
+                        help='finished games to seed (default: %(default)s)')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    if not args.sdk:
+        parser.error('--sdk or $GAE_SDK is required')
+
+    setup_environment(args.sdk)
+    check = CompactionCheck(args)
+    try:
+        check.seed()
+        failures = check.check()
+    finally:
+        check.close()
+    for failure in failures:
+        sys.stdout.write('FAIL {}\n'.format(failure))
+    if failures:
+        return 1
+    sys.stdout.write('OK: compaction did not change the analysis\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
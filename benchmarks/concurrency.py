@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""concurrency.py - Concurrent move stress test for the HangmanApi.
+
+Starts --threads threads that all make moves on the same few Games through
+make_move, against the App Engine testbed stubs, so that moves on one Game
+constantly race.  Reports moves per second, p50/p99 latency and the number
+of moves rejected with a 409 after every transaction attempt failed, then
+checks that no move was lost or applied twice:
+
+* every letter a thread was told was applied appears in the Game's guesses
+  exactly once, and the Game holds no other guess;
+* attempts_remaining, moves and game_over agree with replaying the guesses;
+* every finished Game has exactly one Score, and the UserStats and active
+  Game counters match the Games.
+
+Exits with status 1 if any check fails.
+
+Usage:
+    python benchmarks/concurrency.py --sdk ~/google_appengine \\
+        --games 4 --threads 16
+"""
+
+import argparse
+import collections
+import os
+import random
+import sys
+import threading
+import time
+
+from benchmark import ROOT_DIR, LETTERS, percentile, setup_environment
+
+
+class StressTest(object):
+    """Seeds the stubs, runs the threads and checks the result"""
+
+    def __init__(self, args):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+        self.args = args
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # Endpoints reads the app revision from the minor version
+        self.testbed.setup_env(current_version_id='testbed.1',
+                               overwrite=True)
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.
+            PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT_DIR)
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_app_identity_stub()
+
+        import endpoints
+        import api
+        self.endpoints = endpoints
+        self.api = api
+        self.service = api.HangmanApi()
+        self.lock = threading.Lock()
+        # urlsafe game key -> letters reported as applied
+        self.applied = collections.defaultdict(list)
+        self.latencies = []
+        self.conflicts = 0
+        self.errors = []
+
+    def close(self):
+        self.testbed.deactivate()
+
+    def seed(self):
+        from models import User, GameDifficulty
+        difficulty = getattr(GameDifficulty, self.args.difficulty)
+        self.user_names = ['stress{}'.format(i)
+                           for i in range(self.args.games)]
+        for name in self.user_names:
+            User.create(name, '{}@example.com'.format(name))
+        self.game_keys = [
+            self.service.new_game(self.api.NEW_GAME_REQUEST.
+                                  combined_message_class(
+                                      user_name=name,
+                                      difficulty=difficulty))
+            .urlsafe_key for name in self.user_names]
+
+    def worker(self, seed):
+        """Guesses the letters in a random order on random Games until every
+        Game is over"""
+        rng = random.Random(seed)
+        pending = dict((key, rng.sample(LETTERS, len(LETTERS)))
+                       for key in self.game_keys)
+        request_class = self.api.MAKE_MOVE_REQUEST.combined_message_class
+        while pending:
+            key = rng.choice(pending.keys())
+            guess = pending[key].pop()
+            if not pending[key]:
+                del pending[key]
+            start = time.time()
+            try:
+                form = self.service.make_move(request_class(
+                    urlsafe_game_key=key, guess=guess))
+            except self.endpoints.ConflictException:
+                with self.lock:
+                    self.conflicts += 1
+                continue
+            except Exception as e:
+                with self.lock:
+                    self.errors.append('{}: {!r}'.format(guess, e))
+                continue
+            elapsed_ms = (time.time() - start) * 1000
+            applied = not form.message.startswith('You have already') and \
+                form.message != 'Game already over!'
+            with self.lock:
+                self.latencies.append(elapsed_ms)
+                if applied:
+                    self.applied[key].append(guess)
+            if form.game_over:
+                pending.pop(key, None)
+
+    def run(self):
+        threads = [threading.Thread(target=self.worker, args=(seed,))
+                   for seed in range(self.args.threads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.time() - start
+
+    def check(self):
+        """Returns the list of invariant violations"""
+        from google.appengine.ext import ndb
+        import counters
+        from models import Game, Score, UserStats, _reveal
+        # The seeding cached counter shards in this thread's context
+        ndb.get_context().clear_cache()
+        failures = list(self.errors)
+        finished = 0
+        attempts_remaining = 0
+        for urlsafe in self.game_keys:
+            game = ndb.Key(urlsafe=urlsafe).get(use_cache=False,
+                                                use_memcache=False)
+            applied = self.applied[urlsafe]
+            if sorted(applied) != sorted(game.guesses):
+                failures.append('{}: applied {} but stored {}'.format(
+                    urlsafe, ''.join(sorted(applied)),
+                    ''.join(sorted(game.guesses))))
+            if len(set(game.guesses)) != len(game.guesses):
+                failures.append('{}: duplicate guesses {}'.format(
+                    urlsafe, game.guesses))
+            # Replay the guesses in the stored order
+            revealed, misses = 0, 0
+            solved = (1 << len(game.word)) - 1
+            for guess in game.guesses:
+                revealed, hit = _reveal(game.word, revealed, guess)
+                misses += 0 if hit else 1
+            if game.attempts_remaining != game.attempts_allowed - misses:
+                failures.append('{}: {} attempts remaining, expected {}'
+                                .format(urlsafe, game.attempts_remaining,
+                                        game.attempts_allowed - misses))
+            over = revealed == solved or game.attempts_remaining < 1
+            if game.game_over != over:
+                failures.append('{}: game_over is {}'.format(
+                    urlsafe, game.game_over))
+            won = revealed == solved
+            if len(game.moves) != len(game.guesses) - (1 if won else 0):
+                failures.append('{}: {} moves for {} guesses'.format(
+                    urlsafe, len(game.moves), len(game.guesses)))
+            scores = Score.query(Score.game == game.key).count()
+            if scores != (1 if game.game_over else 0):
+                failures.append('{}: {} scores'.format(urlsafe, scores))
+            if game.game_over:
+                finished += 1
+                stats = UserStats.key_for(
+                    game.user, game.difficulty).get(use_cache=False)
+                if stats is None or stats.games != 1:
+                    failures.append('{}: UserStats {}'.format(
+                        urlsafe, stats and stats.games))
+            else:
+                attempts_remaining += game.attempts_remaining
+        active, total_attempts = counters.get_counts(
+            counters.ACTIVE_GAMES, counters.ATTEMPTS_REMAINING)
+        if (active, total_attempts) != (len(self.game_keys) - finished,
+                                        attempts_remaining):
+            failures.append('counters: {} active games and {} attempts '
+                            'remaining, expected {} and {}'.format(
+                                active, total_attempts,
+                                len(self.game_keys) - finished,
+                                attempts_remaining))
+        return failures
+
+    def report(self, out=sys.stdout):
+        from models import GAME_TRANSACTION_RETRIES
+        latencies = sorted(self.latencies)
+        out.write('{} threads, {} games: {} moves in {:.2f}s ({:.0f} '
+                  'moves/sec), p50 {:.2f} ms, p99 {:.2f} ms, {} rejected '
+                  'after {} attempts\n'.format(
+                      self.args.threads, self.args.games, len(latencies),
+                      self.elapsed, len(latencies) / max(self.elapsed, 0.001),
+                      percentile(latencies, 50), percentile(latencies, 99),
+                      self.conflicts,
+                      GAME_TRANSACTION_RETRIES + 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('GAE_SDK'),
+                        help='path of the App Engine Python SDK '
+                             '(default: $GAE_SDK)')
+    parser.add_argument('--games', type=int, default=4,
+                        help='games the threads share (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--difficulty', default='EXPERT',
+                        help='difficulty of the games; EXPERT games last '
+                             'longest (default: %(default)s)')
+    args = parser.parse_args(argv)
+    if not args.sdk:
+        parser.error('--sdk or $GAE_SDK is required')
+
+    setup_environment(args.sdk)
+    test = StressTest(args)
+    try:
+        test.seed()
+        test.run()
+        test.report()
+        failures = test.check()
+    finally:
+        test.close()
+    for failure in failures:
+        sys.stdout.write('FAIL {}\n'.format(failure))
+    if failures:
+        return 1
+    sys.stdout.write('OK: no move was lost or applied twice\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
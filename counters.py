@@ -0,0 +1,81 @@
+"""counters.py - Sharded counters for totals that change on almost every
+request, such as the number of active Games.  Each counter is split over
+NUM_SHARDS entities so concurrent updates rarely contend on one entity
+group, and reading a counter is a single batch get of its shards."""
+
+import random
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 20
+
+ACTIVE_GAMES = 'active_games'
+ATTEMPTS_REMAINING = 'attempts_remaining'
+
+MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+
+
+class CounterShard(ndb.Model):
+    """One shard of a named counter"""
+    count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+def _shard_keys(name):
+    """Returns the keys of every shard of a counter"""
+    return [ndb.Key(CounterShard, '{}-{}'.format(name, index))
+            for index in range(NUM_SHARDS)]
+
+
+def increment(deltas):
+    """Adds to one or more counters in a single transaction.
+    Args:
+        :deltas <dict>: maps counter names to the (possibly negative) amount
+            to add
+    """
+    increment_async(deltas).get_result()
+
+
+@ndb.transactional_tasklet(xg=True)
+def increment_async(deltas):
+    """Asynchronous version of increment; returns a Future"""
+    items = deltas.items()
+    keys = [ndb.Key(CounterShard,
+                    '{}-{}'.format(name, random.randint(0, NUM_SHARDS - 1)))
+            for name, _ in items]
+    shards = yield ndb.get_multi_async(keys)
+    shards = [shard or CounterShard(key=key)
+              for key, shard in zip(keys, shards)]
+    for shard, (_, delta) in zip(shards, items):
+        shard.count += delta
+    yield ndb.put_multi_async(shards)
+
+
+def get_counts(*names):
+    """Returns the current values of the named counters, in order"""
+    keys = []
+    for name in names:
+        keys.extend(_shard_keys(name))
+    shards = ndb.get_multi(keys)
+    return [sum(shard.count for shard in shards[i:i + NUM_SHARDS] if shard)
+            for i in range(0, len(shards), NUM_SHARDS)]
+
+
+def cache_average_attempts():
+    """Populates memcache with the average moves remaining of active Games,
+    read from the counters.  Returns the message."""
+    count, total_attempts_remaining = get_counts(ACTIVE_GAMES,
+                                                 ATTEMPTS_REMAINING)
+    message = ''
+    if count > 0:
+        average = float(total_attempts_remaining)/count
+        message = 'The average moves remaining is {:.2f}'.format(average)
+    memcache.set(MEMCACHE_MOVES_REMAINING, message)
+    return message
+
+
+@ndb.transactional(xg=True)
+def reset(name, value=0):
+    """Sets a counter to value"""
+    shards = [CounterShard(key=key) for key in _shard_keys(name)]
+    shards[0].count = value
+    ndb.put_multi(shards)
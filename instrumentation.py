@@ -0,0 +1,185 @@
+"""instrumentation.py - Per-request API call counts and timings.
+
+apiproxy hooks count every RPC made while a request is handled (by
+service and method) and time them by service.  The WSGI middleware emits
+one structured log line per request and adds the request to rolling
+per-endpoint aggregates in memcache, which the admin stats handler reads.
+The cost per request is two hook calls per RPC and one memcache RPC.
+
+Entry point modules record how long they took to import; the times are
+logged, and added to the log line of the first request of the instance."""
+
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+# Aggregates are kept in buckets of BUCKET_SECONDS; old buckets are left
+# for memcache to evict
+BUCKET_SECONDS = 5 * 60
+MEMCACHE_STATS = 'STATS_{}_'
+METRICS = ['requests', 'errors', 'latency_ms',
+           'datastore_v3', 'datastore_v3_ms',
+           'memcache', 'memcache_ms',
+           'taskqueue', 'taskqueue_ms']
+
+_local = threading.local()
+_install_lock = threading.Lock()
+_installed_on = None
+_first_request = True
+
+# Milliseconds each entry point module took to import on this instance
+IMPORT_MS = {}
+
+
+class RequestStats(object):
+    """The RPCs made while handling one request"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.calls = {}
+        self.service_ms = {}
+
+    def record(self, service, call, elapsed_ms):
+        key = '{}.{}'.format(service, call)
+        self.calls[key] = self.calls.get(key, 0) + 1
+        self.service_ms[service] = (self.service_ms.get(service, 0.0) +
+                                    elapsed_ms)
+
+    def service_calls(self, service):
+        prefix = service + '.'
+        return sum(count for key, count in self.calls.iteritems()
+                   if key.startswith(prefix))
+
+    def to_dict(self, status):
+        return {'endpoint': self.name,
+                'status': status,
+                'latency_ms': round((time.time() - self.start) * 1000, 1),
+                'rpcs': self.calls,
+                'rpc_ms': dict((service, round(ms, 1)) for service, ms
+                               in self.service_ms.iteritems())}
+
+
+def current_stats():
+    """Returns the RequestStats of the request being handled, or None"""
+    return getattr(_local, 'stats', None)
+
+
+def _pre_call(service, call, request, response, rpc):
+    if current_stats() is not None and rpc is not None:
+        rpc._instrumentation_start = time.time()
+
+
+def _post_call(service, call, request, response, rpc):
+    stats = current_stats()
+    if stats is None:
+        return
+    start = getattr(rpc, '_instrumentation_start', None)
+    elapsed_ms = (time.time() - start) * 1000 if start else 0.0
+    stats.record(service, call, elapsed_ms)
+
+
+def install():
+    """Adds the hooks to the current apiproxy, once"""
+    global _installed_on
+    apiproxy = apiproxy_stub_map.apiproxy
+    if _installed_on is apiproxy:
+        return
+    with _install_lock:
+        if _installed_on is not apiproxy:
+            apiproxy.GetPreCallHooks().Append('instrumentation', _pre_call)
+            apiproxy.GetPostCallHooks().Append('instrumentation', _post_call)
+            _installed_on = apiproxy
+
+
+def record_import_time(name, start):
+    """Records the import time of a module whose import began at start"""
+    IMPORT_MS[name] = round((time.time() - start) * 1000, 1)
+    logging.info('import_time %s', json.dumps({'module': name,
+                                               'ms': IMPORT_MS[name]}))
+
+
+def _endpoint_name(environ):
+    """Names an endpoints method by its SPI path, and handlers by URL"""
+    path = environ.get('PATH_INFO', '')
+    if path.startswith('/_ah/spi/'):
+        return path[len('/_ah/spi/'):]
+    return path
+
+
+def _record(stats, status):
+    """Logs a request and adds it to the aggregates in memcache"""
+    global _first_request
+    result = stats.to_dict(status)
+    if _first_request:
+        with _install_lock:
+            if _first_request:
+                result['cold_start'] = True
+                result['import_ms'] = dict(IMPORT_MS)
+                _first_request = False
+    logging.info('request_stats %s', json.dumps(result, sort_keys=True))
+    deltas = {'requests': 1,
+              'errors': 1 if status >= 500 else 0,
+              'latency_ms': int(result['latency_ms'])}
+    for service in ('datastore_v3', 'memcache', 'taskqueue'):
+        deltas[service] = stats.service_calls(service)
+        deltas[service + '_ms'] = int(stats.service_ms.get(service, 0))
+    bucket = int(stats.start) // BUCKET_SECONDS
+    memcache.offset_multi(
+        dict(('{}|{}'.format(stats.name, metric), value)
+             for metric, value in deltas.iteritems() if value),
+        key_prefix=MEMCACHE_STATS.format(bucket), initial_value=0)
+
+
+def middleware(app):
+    """Wraps a WSGI application so that each request is instrumented"""
+    def instrumented_app(environ, start_response):
+        install()
+        stats = RequestStats(_endpoint_name(environ))
+        status = []
+
+        def _start_response(status_line, headers, exc_info=None):
+            status.append(int(status_line.split(' ', 1)[0]))
+            return start_response(status_line, headers, exc_info)
+
+        _local.stats = stats
+        try:
+            return app(environ, _start_response)
+        except Exception:
+            status.append(500)
+            raise
+        finally:
+            _local.stats = None
+            try:
+                _record(stats, status[-1] if status else 500)
+            except Exception:
+                logging.exception('Unable to record request stats')
+    return instrumented_app
+
+
+def get_aggregates(names, seconds=60 * 60):
+    """Returns the aggregates of the named endpoints over the last seconds,
+    as {name: {metric: value}}, with per-request averages"""
+    now = int(time.time()) // BUCKET_SECONDS
+    buckets = range(now - seconds // BUCKET_SECONDS + 1, now + 1)
+    keys = ['{}{}|{}'.format(MEMCACHE_STATS.format(bucket), name, metric)
+            for bucket in buckets for name in names for metric in METRICS]
+    values = memcache.get_multi(keys)
+    aggregates = {}
+    for name in names:
+        totals = dict((metric, 0) for metric in METRICS)
+        for bucket in buckets:
+            prefix = MEMCACHE_STATS.format(bucket)
+            for metric in METRICS:
+                totals[metric] += int(values.get(
+                    '{}{}|{}'.format(prefix, name, metric), 0))
+        if totals['requests']:
+            for metric in METRICS[2:]:
+                totals[metric + '_avg'] = round(
+                    float(totals[metric]) / totals['requests'], 2)
+            aggregates[name] = totals
+    return aggregates
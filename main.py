@@ -1,47 +1,664 @@
 #!/usr/bin/env python
 
 """main.py - This file contains handlers that are called by taskqueue and/or
-cronjobs."""
+cronjobs.  It does not import the API module (api.py), so task and cron
+requests do not pay for building the Endpoints server."""
+import time
+IMPORT_START = time.time()
+
+import csv
+import json
 import logging
+from cStringIO import StringIO
+from datetime import date, datetime, timedelta
 
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import HangmanApi
+from google.appengine.api import mail, app_identity, memcache, taskqueue
+from google.appengine.ext import ndb
+
+import analytics
+import counters
+import instrumentation
+import words
+from models import User, Game, Score, UserStats, DailyScoreAggregate
+from models import GameDifficulty, Leaderboard
+from models import get_users_by_key
 
-from models import User, Game
+BACKFILL_BATCH_SIZE = 50
+REMINDER_BATCH_SIZE = 100
+MIGRATION_BATCH_SIZE = 20
+PUT_BATCH_SIZE = 500
+# Losing Scores older than this are folded into DailyScoreAggregates
+SCORE_RETENTION_DAYS = 90
+COMPACTION_BATCH_SIZE = 500
+# Scores folded per transaction; a transaction can span 25 entity groups
+COMPACTION_FOLD_SIZE = 20
+# Seconds a compaction task works before handing over to the next task
+COMPACTION_TIME_BUDGET = 8 * 60
+# Active Games without a move for this long are ended as losses
+STALE_GAME_DAYS = 14
+EXPIRY_BATCH_SIZE = 50
+EXPIRY_TIME_BUDGET = 8 * 60
+ANALYTICS_BATCH_SIZE = 1000
+ANALYTICS_TIME_BUDGET = 8 * 60
+EXPORT_PAGE_SIZE = 500
+# An export response returns its resume cursor after this many seconds, or
+# once it holds this many bytes.  The response is held in memory until the
+# handler returns and App Engine rejects responses over 32MB; a page of Game
+# histories stays well under the remaining margin.
+EXPORT_TIME_BUDGET = 45
+EXPORT_MAX_BYTES = 16 * 1024 * 1024
+REMINDER_SUBJECT = 'Your Hangman move is waiting for you'
+REMINDER_TASK_NAME = 'reminders-{}-{}'
+REMINDER_MAIL_TASK_NAME = 'reminder-{}-{}'
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email to make.
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
+        """Send a reminder email to each User with an email and active Games.
+        Called every hour using a cron job.  The Games are processed in
+        batches by /tasks/send_reminders."""
+        run = str(int(time.time() * 1000))
+        add_reminder_batch(run, 0)
+        logging.info('Reminder run %s started', run)
+
+
+def add_reminder_batch(run, page, **params):
+    """Queues the batch of a reminder run with the given page number.
+    The task is named after the run and page, so a retried batch cannot
+    queue a second copy of the rest of the chain."""
+    params.update(run=run, page=page)
+    try:
+        taskqueue.add(url='/tasks/send_reminders', params=params,
+                      name=REMINDER_TASK_NAME.format(run, page))
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+def add_reminder_mails(run, mails):
+    """Queues a /tasks/send_reminder_mail task per (User key, email, body)
+    of a reminder run, with one batch add per 100 tasks.  The tasks are
+    named after the run and User, so a retried batch cannot mail a User a
+    second time."""
+    tasks = [taskqueue.Task(url='/tasks/send_reminder_mail',
+                            params={'email': email, 'body': body},
+                            name=REMINDER_MAIL_TASK_NAME.format(
+                                run, user_key.urlsafe()))
+             for user_key, email, body in mails]
+    queue = taskqueue.Queue()
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # The tasks not queued before are queued all the same
+            pass
 
-        games = Game.query(Game.game_over == False)
+
+class SendReminderBatch(webapp2.RequestHandler):
+    def post(self):
+        """Queue one digest email to each User of a batch of active Games.
+        Games are read in User order, so all of a User's Games are sent in
+        the same batch.  The next batch is queued before the mails, so
+        batches of a run are processed concurrently."""
+        start = time.time()
+        run = self.request.get('run')
+        page = int(self.request.get('page', 0))
+        cursor = self.request.get('cursor')
+        skip_user = self.request.get('skip_user')
+        skip_user = ndb.Key(urlsafe=skip_user) if skip_user else None
+
+        query = Game.query(Game.game_over == False).order(Game.user)
+        games, cursor, more = query.fetch_page(
+            REMINDER_BATCH_SIZE,
+            start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None)
+        # The previous batch already sent the digest of skip_user
+        games = [game for game in games if game.user != skip_user]
+
+        games_by_user = {}
         for game in games:
-            user = User.query(User.key == game.user).get()
-            subject = 'Your Hangman move is waiting for you'
-            body = "Hi {}, don't forget to make your move in Hangman!\n"\
-                .format(user.name)
-            body += "The current status of your game is {}, "\
-                .format(game.get_guess_status())
-            body += "and you have {} guesses left."\
-                .format(str(game.attempts_remaining))
-            if user.email != None:
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                                user.email,
-                                subject,
-                                body)
+            games_by_user.setdefault(game.user, []).append(game)
+        if more and cursor:
+            # The last User's Games may continue past this batch; include
+            # them all here and have the next batch skip that User.
+            last_user = games[-1].user if games else skip_user
+            if games:
+                seen = set(game.key for game in games_by_user[last_user])
+                games_by_user[last_user].extend(
+                    game for game in Game.query(Game.game_over == False,
+                                                Game.user == last_user)
+                    if game.key not in seen)
+            add_reminder_batch(run, page + 1, cursor=cursor.urlsafe(),
+                               skip_user=last_user.urlsafe())
+
+        users = ndb.get_multi(games_by_user.keys())
+        mails = [(user.key, user.email,
+                  build_reminder_body(user, games_by_user[user.key]))
+                 for user in users if user and user.email]
+        add_reminder_mails(run, mails)
+        emails = len(mails)
+
+        elapsed = time.time() - start
+        totals = memcache.offset_multi(
+            {'games': len(games), 'emails': emails},
+            key_prefix='REMINDERS_{}_'.format(run), initial_value=0) or {}
+        logging.info('Reminder run %s batch: %d games, %d users, %d emails '
+                     'in %.2fs (%.1f emails/s); run totals: %s',
+                     run, len(games), len(users), emails, elapsed,
+                     emails / elapsed if elapsed else 0.0, totals)
+        if not more:
+            logging.info('Reminder run %s finished', run)
+        self.response.set_status(204)
+
+
+class SendReminderMail(webapp2.RequestHandler):
+    def post(self):
+        """Send one reminder email, queued by /tasks/send_reminders"""
+        sender = 'noreply@{}.appspotmail.com'.format(
+            app_identity.get_application_id())
+        mail.send_mail(sender, self.request.get('email'), REMINDER_SUBJECT,
+                       self.request.get('body'))
+        self.response.set_status(204)
+
+
+def build_reminder_body(user, games):
+    """Returns the body of a reminder email for a User's active Games"""
+    body = "Hi {}, don't forget to make your move in Hangman!\n"\
+        .format(user.name)
+    for game in games:
+        body += "The current status of your game is {}, "\
+            .format(game.get_guess_status())
+        body += "and you have {} guesses left.\n"\
+            .format(str(game.attempts_remaining))
+    return body
 
 
 class UpdateAverageMovesRemaining(webapp2.RequestHandler):
     def post(self):
         """Update game listing announcement in memcache."""
-        HangmanApi._cache_average_attempts()
+        counters.cache_average_attempts()
+        self.response.set_status(204)
+
+
+class BackfillUserStats(webapp2.RequestHandler):
+    def get(self):
+        """Start rebuilding every User's UserStats from their Scores.
+        Admin only."""
+        taskqueue.add(url='/tasks/backfill_user_stats')
+        self.response.write('UserStats backfill started.')
+
+    def post(self):
+        """Rebuild the UserStats of one batch of Users, then queue the
+        next batch."""
+        cursor = self.request.get('cursor')
+        users, cursor, more = User.query().fetch_page(
+            BACKFILL_BATCH_SIZE,
+            start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None)
+        if more and cursor:
+            taskqueue.add(url='/tasks/backfill_user_stats',
+                          params={'cursor': cursor.urlsafe()})
+
+        # Query the Scores and compacted Scores of the whole batch
+        # concurrently
+        futures = [(Score.query(Score.user == user.key).fetch_async(),
+                    DailyScoreAggregate.query(ancestor=user.key).fetch_async())
+                   for user in users]
+        stats = []
+        for user, (scores, aggregates) in zip(users, futures):
+            totals = {}
+            for score in scores.get_result():
+                games, wins = totals.get(score.difficulty, (0, 0))
+                totals[score.difficulty] = (games + 1,
+                                            wins + (1 if score.won else 0))
+            for aggregate in aggregates.get_result():
+                games, wins = totals.get(aggregate.difficulty, (0, 0))
+                totals[aggregate.difficulty] = (games + aggregate.games,
+                                                wins + aggregate.wins)
+            for difficulty, (games, wins) in totals.iteritems():
+                user_stats = UserStats(
+                    key=UserStats.key_for(user.key, difficulty),
+                    user=user.key, user_name=user.name, difficulty=difficulty)
+                user_stats.set_totals(games, wins)
+                stats.append(user_stats)
+        ndb.put_multi(stats)
+        logging.info('Backfilled %d UserStats for %d users',
+                     len(stats), len(users))
+        self.response.set_status(204)
+
+
+class CompactScores(webapp2.RequestHandler):
+    def get(self):
+        """Start folding losing Scores older than SCORE_RETENTION_DAYS into
+        DailyScoreAggregates.  Called every day using a cron job.  Winning
+        Scores are kept, so high scores and a rebuilt Leaderboard still
+        see every win."""
+        cutoff = date.today() - timedelta(days=SCORE_RETENTION_DAYS)
+        taskqueue.add(url='/tasks/compact_scores',
+                      params={'cutoff': cutoff.isoformat()})
+
+    def post(self):
+        """Fold batches of old Scores until the time budget is used, then
+        queue a task to continue from the cursor."""
+        start = time.time()
+        cutoff = self.request.get('cutoff')
+        cursor = self.request.get('cursor')
+        cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+        query = Score.query(
+            Score.won == False,
+            Score.date < date(*map(int, cutoff.split('-')))).order(Score.date)
+        folded = 0
+        more = True
+        while more and time.time() - start < COMPACTION_TIME_BUDGET:
+            scores, cursor, more = query.fetch_page(
+                COMPACTION_BATCH_SIZE, start_cursor=cursor)
+            keys_by_user = {}
+            for score in scores:
+                keys_by_user.setdefault(score.user, []).append(score.key)
+            for user_key, keys in keys_by_user.iteritems():
+                for i in range(0, len(keys), COMPACTION_FOLD_SIZE):
+                    folded += DailyScoreAggregate.fold(
+                        user_key, keys[i:i + COMPACTION_FOLD_SIZE])
+        if more and cursor:
+            taskqueue.add(url='/tasks/compact_scores',
+                          params={'cutoff': cutoff,
+                                  'cursor': cursor.urlsafe()})
+        logging.info('Compacted %d losing scores older than %s in %.1fs%s',
+                     folded,
+                     cutoff, time.time() - start,
+                     '; continuing' if more else '')
+        self.response.set_status(204)
+
+
+class ExpireStaleGames(webapp2.RequestHandler):
+    def get(self):
+        """Start ending the active Games without a move in the last
+        STALE_GAME_DAYS.  Called every day using a cron job."""
+        cutoff = datetime.now() - timedelta(days=STALE_GAME_DAYS)
+        taskqueue.add(url='/tasks/expire_games',
+                      params={'cutoff': cutoff.strftime('%Y-%m-%dT%H:%M:%S')})
+
+    def post(self):
+        """End batches of stale Games until the time budget is used, then
+        queue a task to continue from the cursor.  The Games are found with
+        a keys only query and ended through Game.expire_multi, so each gets a
+        losing Score."""
+        start = time.time()
+        cutoff = self.request.get('cutoff')
+        cursor = self.request.get('cursor')
+        cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+        cutoff_time = datetime.strptime(cutoff, '%Y-%m-%dT%H:%M:%S')
+        query = Game.query(Game.game_over == False,
+                           Game.last_move < cutoff_time)
+        count = 0
+        total_attempts_remaining = 0
+        more = True
+        while more and time.time() - start < EXPIRY_TIME_BUDGET:
+            keys, cursor, more = query.fetch_page(
+                EXPIRY_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+            for _, attempts_remaining in Game.expire_multi(keys,
+                                                           cutoff_time):
+                count += 1
+                total_attempts_remaining += attempts_remaining
+        if more and cursor:
+            taskqueue.add(url='/tasks/expire_games',
+                          params={'cutoff': cutoff,
+                                  'cursor': cursor.urlsafe()})
+        if count:
+            counters.increment({counters.ACTIVE_GAMES: -count,
+                                counters.ATTEMPTS_REMAINING:
+                                    -total_attempts_remaining})
+            counters.cache_average_attempts()
+        logging.info('Expired %d games without a move since %s in %.1fs%s',
+                     count, cutoff, time.time() - start,
+                     '; continuing' if more else '')
+        self.response.set_status(204)
+
+
+class RebuildGameCounters(webapp2.RequestHandler):
+    def get(self):
+        """Start recounting the active Game counters.  Admin only."""
+        taskqueue.add(url='/tasks/rebuild_game_counters')
+        self.response.write('Active game counters rebuild started.')
+
+    def post(self):
+        """Reset the active Game counters from a scan of the active Games.
+        Only needed once, for Games created before the counters existed.
+        Active Games saved before Game.last_move existed are given one, so
+        the expire_games job ends them if they stay inactive."""
+        def stamp(game):
+            if game.last_move is None:
+                game.last_move = datetime.now()
+
+        count = 0
+        total_attempts_remaining = 0
+        unstamped = []
+        for game in Game.query(Game.game_over == False).iter(batch_size=500):
+            count += 1
+            total_attempts_remaining += game.attempts_remaining
+            if game.last_move is None:
+                unstamped.append(game.key)
+        # Games can be moved on meanwhile, so each is updated in a
+        # transaction
+        for i in range(0, len(unstamped), MIGRATION_BATCH_SIZE):
+            Game.update_multi(unstamped[i:i + MIGRATION_BATCH_SIZE], stamp)
+        counters.reset(counters.ACTIVE_GAMES, count)
+        counters.reset(counters.ATTEMPTS_REMAINING, total_attempts_remaining)
+        counters.cache_average_attempts()
+        self.response.set_status(204)
+
+
+class MigrateUserKeys(webapp2.RequestHandler):
+    def get(self):
+        """Start re-keying Users created before Users were keyed by name.
+        Admin only."""
+        taskqueue.add(url='/tasks/migrate_user_keys')
+        self.response.write('User key migration started.')
+
+    def post(self):
+        """Re-key one batch of Users, then queue the next batch.  Each
+        User is copied to its name key, its Games, Scores and UserStats are
+        moved to the new key, and the old User is deleted last, so an
+        interrupted migration resumes where it stopped."""
+        cursor = self.request.get('cursor')
+        users, cursor, more = User.query().fetch_page(
+            MIGRATION_BATCH_SIZE,
+            start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None)
+        if more and cursor:
+            taskqueue.add(url='/tasks/migrate_user_keys',
+                          params={'cursor': cursor.urlsafe()})
+        migrated = 0
+        for user in users:
+            new_key = User.key_for_name(user.name)
+            if user.key == new_key:
+                continue
+            existing = new_key.get()
+            if existing and existing.name != user.name:
+                logging.warning('Not migrating user %s: name conflicts with '
+                                'user %s', user.name, existing.name)
+                continue
+            if not existing:
+                User(key=new_key, name=user.name, email=user.email).put()
+            self._move_references(user.key, new_key)
+            user.key.delete()
+            migrated += 1
+        logging.info('Migrated %d of %d users', migrated, len(users))
+        self.response.set_status(204)
+
+    @staticmethod
+    def _move_references(old_key, new_key):
+        """Points the Games, Scores, UserStats and DailyScoreAggregates of
+        a User at its new key"""
+        # Games can be moved on meanwhile, so each is updated in a
+        # transaction
+        def set_user(game):
+            game.user = new_key
+        game_keys = Game.query(Game.user == old_key).fetch(keys_only=True)
+        for i in range(0, len(game_keys), MIGRATION_BATCH_SIZE):
+            Game.update_multi(game_keys[i:i + MIGRATION_BATCH_SIZE], set_user)
+        scores = Score.query(Score.user == old_key).fetch()
+        for score in scores:
+            score.user = new_key
+        for i in range(0, len(scores), PUT_BATCH_SIZE):
+            ndb.put_multi(scores[i:i + PUT_BATCH_SIZE])
+        old_stats = UserStats.query(ancestor=old_key).fetch()
+        new_stats = []
+        for stats in old_stats:
+            new_stats.append(UserStats(
+                key=UserStats.key_for(new_key, stats.difficulty),
+                user=new_key, user_name=stats.user_name,
+                difficulty=stats.difficulty, games=stats.games,
+                wins=stats.wins, win_percentage=stats.win_percentage))
+        ndb.put_multi(new_stats)
+        ndb.delete_multi([stats.key for stats in old_stats])
+        old_aggregates = DailyScoreAggregate.query(ancestor=old_key).fetch()
+        new_aggregates = []
+        for aggregate in old_aggregates:
+            new_aggregates.append(DailyScoreAggregate(
+                key=DailyScoreAggregate.key_for(new_key, aggregate.date,
+                                                aggregate.difficulty),
+                user=new_key, date=aggregate.date,
+                difficulty=aggregate.difficulty, games=aggregate.games,
+                wins=aggregate.wins, guesses=aggregate.guesses))
+        for i in range(0, len(new_aggregates), PUT_BATCH_SIZE):
+            ndb.put_multi(new_aggregates[i:i + PUT_BATCH_SIZE])
+        ndb.delete_multi([aggregate.key for aggregate in old_aggregates])
+
+
+class ExportHandler(webapp2.RequestHandler):
+    """Base class of the admin exports.  Entities are read a page at a time
+    and serialized as NDJSON (the default) or CSV (?format=csv).  The
+    response is only sent when the handler returns, so the whole body is
+    held in memory: an export stops after the page that takes it past
+    EXPORT_MAX_BYTES or EXPORT_TIME_BUDGET seconds, and returns the
+    X-Next-Cursor header; passing it back as ?cursor= resumes the export
+    where it stopped.  Subclasses define FIELDS, query() and
+    to_row(entity, users)."""
+    FIELDS = []
+
+    def query(self):
+        raise NotImplementedError
+
+    def to_row(self, entity, users):
+        raise NotImplementedError
+
+    def get(self):
+        start = time.time()
+        export_format = self.request.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            self.abort(400, 'format must be ndjson or csv')
+        cursor = self.request.get('cursor')
+        cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+
+        written = 0
+        if export_format == 'csv':
+            self.response.headers['Content-Type'] = 'text/csv'
+            header = self._csv_lines([self.FIELDS])
+            self.response.write(header)
+            written += len(header)
+        else:
+            self.response.headers['Content-Type'] = 'application/x-ndjson'
+        more = False
+        for rows, cursor, more in self._pages(cursor):
+            if export_format == 'csv':
+                text = self._csv_lines(
+                    [[row[field] for field in self.FIELDS] for row in rows])
+            else:
+                text = ''.join(json.dumps(row, sort_keys=True) + '\n'
+                               for row in rows)
+            self.response.write(text)
+            written += len(text)
+            if (written >= EXPORT_MAX_BYTES or
+                    time.time() - start >= EXPORT_TIME_BUDGET):
+                break
+        if more and cursor:
+            self.response.headers['X-Next-Cursor'] = cursor.urlsafe()
+
+    def _pages(self, cursor):
+        """Yields (rows, cursor, more) for each page of the query, until
+        the query is exhausted.  The Users of a page are resolved with one
+        batch get, and the context cache is cleared after each page so that
+        only the serialized rows accumulate."""
+        more = True
+        while more:
+            entities, cursor, more = self.query().fetch_page(
+                EXPORT_PAGE_SIZE, start_cursor=cursor)
+            users = get_users_by_key(entity.user for entity in entities)
+            yield ([self.to_row(entity, users) for entity in entities],
+                   cursor, more)
+            ndb.get_context().clear_cache()
+
+    @staticmethod
+    def _csv_lines(rows):
+        """Returns rows as CSV text"""
+        out = StringIO()
+        writer = csv.writer(out)
+        for row in rows:
+            writer.writerow([value.encode('utf-8')
+                             if isinstance(value, unicode) else value
+                             for value in row])
+        return out.getvalue()
+
+
+class ExportScores(ExportHandler):
+    """Exports every Score, optionally of one ?difficulty=.  Admin only."""
+    FIELDS = ['game', 'user_name', 'date', 'difficulty', 'won', 'guesses']
+
+    def query(self):
+        query = Score.query()
+        difficulty = self.request.get('difficulty')
+        if difficulty:
+            query = query.filter(Score.difficulty == difficulty.upper())
+        return query
+
+    def to_row(self, score, users):
+        user = users[score.user]
+        return {'game': score.game.urlsafe(),
+                'user_name': user.name if user else None,
+                'date': str(score.date),
+                'difficulty': score.difficulty,
+                'won': score.won,
+                'guesses': score.guesses}
+
+
+class ExportGames(ExportHandler):
+    """Exports the history of every Game.  In CSV the history entries are
+    joined with ' | '.  Admin only."""
+    FIELDS = ['game', 'user_name', 'difficulty', 'game_over', 'history']
+
+    def query(self):
+        return Game.query()
+
+    def to_row(self, game, users):
+        user = users[game.user]
+        return {'game': game.key.urlsafe(),
+                'user_name': user.name if user else None,
+                'difficulty': game.difficulty,
+                'game_over': game.game_over,
+                'history': game.get_history()}
+
+    @staticmethod
+    def _csv_lines(rows):
+        return ExportHandler._csv_lines(
+            [[' | '.join(value) if isinstance(value, list) else value
+              for value in row] for row in rows])
+
+
+class AnalyzeGames(webapp2.RequestHandler):
+    def get(self):
+        """Start a new analysis of the finished Games.  Called every week
+        using a cron job, or by an admin."""
+        # A day inside the compaction cutoff, so a run that spans a
+        # compaction does not lose losing Scores it has not read yet
+        since = date.today() - timedelta(days=SCORE_RETENTION_DAYS - 1)
+        run = analytics.AnalyticsSummary.start(since)
+        taskqueue.add(url='/tasks/analyze_games',
+                      params={'run': run.run_id()})
+        self.response.write('Game analysis started.')
+
+    def post(self):
+        """Add batches of Scores and their Games to the running analysis
+        until the time budget is used, then queue a task to continue from
+        the cursor, or store the summary when every Score has been read.
+        Tasks of a run that was replaced by a newer one are dropped."""
+        start = time.time()
+        run_id = self.request.get('run')
+        run = analytics.AnalyticsSummary.get_running(run_id)
+        if run is None:
+            logging.warning('Game analysis %s is not running', run_id)
+            return
+        cursor = self.request.get('cursor')
+        cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+        query = Score.query()
+        if run.since:
+            # Runs started before since was recorded scan every Score
+            query = Score.query(Score.date >= run.since).order(Score.date)
+        more = True
+        while more and time.time() - start < ANALYTICS_TIME_BUDGET:
+            scores, cursor, more = query.fetch_page(
+                ANALYTICS_BATCH_SIZE, start_cursor=cursor)
+            run.add_scores(scores)
+            # The batch's entities are not needed again
+            ndb.get_context().clear_cache()
+        if more and cursor:
+            if run.save():
+                taskqueue.add(url='/tasks/analyze_games',
+                              params={'run': run_id,
+                                      'cursor': cursor.urlsafe()})
+        else:
+            run.finish()
+        logging.info('Analyzed %d scores (%d skipped) in %.1fs%s', run.scores,
+                     run.skipped, time.time() - start,
+                     '; continuing' if more else '')
+        self.response.set_status(204)
+
+
+class AnalyticsReport(webapp2.RequestHandler):
+    def get(self):
+        """Return the summary of the last complete game analysis as JSON.
+        Admin only."""
+        summary = analytics.AnalyticsSummary.get_by_id('latest')
+        if summary is None:
+            self.abort(404, 'No game analysis has completed yet')
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(summary.to_dict(), indent=2,
+                                       sort_keys=True))
+
+
+class RequestStats(webapp2.RequestHandler):
+    def get(self):
+        """Return the per-endpoint request aggregates of the last hour (or
+        ?minutes=N) as JSON.  Admin only."""
+        # Imported here so that other handlers do not load the API
+        from api import HangmanApi
+        minutes = int(self.request.get('minutes') or 60)
+        names = ['HangmanApi.' + name
+                 for name in HangmanApi.all_remote_methods()]
+        names.extend(route[0] for route in ROUTES)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(
+            instrumentation.get_aggregates(names, minutes * 60),
+            indent=2, sort_keys=True))
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Prepare a new instance before it serves traffic: load the word
+        corpus and the API module, and fill the Leaderboard and average
+        attempts caches if they are empty.  Called by App Engine when it
+        starts an instance."""
+        start = time.time()
+        words.preload()
+        # Builds the Endpoints server that serves /_ah/spi requests
+        import api
+        for difficulty in GameDifficulty.names():
+            Leaderboard.get_leaderboard(difficulty)
+        if memcache.get(counters.MEMCACHE_MOVES_REMAINING) is None:
+            counters.cache_average_attempts()
+        logging.info('Warmed up in %.1fs; import times (ms): %s',
+                     time.time() - start,
+                     json.dumps(instrumentation.IMPORT_MS, sort_keys=True))
         self.response.set_status(204)
 
 
-app = webapp2.WSGIApplication([
+ROUTES = [
     ('/crons/send_reminder', SendReminderEmail),
+    ('/crons/compact_scores', CompactScores),
+    ('/tasks/compact_scores', CompactScores),
+    ('/crons/expire_games', ExpireStaleGames),
+    ('/tasks/expire_games', ExpireStaleGames),
+    ('/tasks/send_reminders', SendReminderBatch),
+    ('/tasks/send_reminder_mail', SendReminderMail),
     ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
-], debug=True)
+    ('/tasks/backfill_user_stats', BackfillUserStats),
+    ('/tasks/rebuild_game_counters', RebuildGameCounters),
+    ('/tasks/migrate_user_keys', MigrateUserKeys),
+    ('/tasks/analyze_games', AnalyzeGames),
+    ('/admin/stats', RequestStats),
+    ('/admin/analytics', AnalyticsReport),
+    ('/admin/export/scores', ExportScores),
+    ('/admin/export/games', ExportGames),
+    ('/_ah/warmup', Warmup),
+]
+app = instrumentation.middleware(webapp2.WSGIApplication(ROUTES, debug=True))
+instrumentation.record_import_time(__name__, IMPORT_START)
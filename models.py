@@ -1,22 +1,115 @@
 """models.py - This file contains the class definitions for the Datastore
 entities used by the Game. Because these classes are also regular Python
-classes they can include methods (such as 'to_form' and 'new_game')."""
+classes they can include methods (such as 'to_form' and 'new_games')."""
 
 import random
-import urllib2
-from datetime import date
+from datetime import date, datetime
 from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
+import words
+
 
 # ========== USER ==========
+MEMCACHE_USER_KEY = 'USER_KEY_{}'
+
+
 class User(ndb.Model):
-    """User profile"""
+    """User profile.  Keyed by the normalized (lower case) name, so a User
+    is looked up by name with a key get instead of a query."""
     name = ndb.StringProperty(required=True)
     email =ndb.StringProperty()
 
+    @staticmethod
+    def normalize_name(name):
+        """Returns the key name of a User name"""
+        return str(name).lower()
+
+    @classmethod
+    def key_for_name(cls, name):
+        """Returns the key of the User with the name"""
+        return ndb.Key(cls, cls.normalize_name(name))
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with the name, or None.  Users created before
+            Users were keyed by name, and not migrated yet, are found with a
+            query whose result is cached in memcache.  A User whose name only
+            matches in case is returned only if no User has the exact
+            name."""
+        return cls.get_by_name_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        """Asynchronous version of get_by_name; returns a Future"""
+        if not cls.normalize_name(name).strip():
+            # No User has a blank name, and it makes no complete key
+            raise ndb.Return(None)
+        keyed = yield cls.key_for_name(name).get_async()
+        if keyed is not None and keyed.name == name:
+            raise ndb.Return(keyed)
+        # Not keyed by name yet, or keyed by the name of another User
+        # whose name differs in case
+        context = ndb.get_context()
+        cache_key = MEMCACHE_USER_KEY.format(cls.normalize_name(name))
+        user = None
+        urlsafe = yield context.memcache_get(cache_key)
+        if urlsafe:
+            user = yield ndb.Key(urlsafe=urlsafe).get_async()
+        if user is None:
+            user = yield cls.query(cls.name == name).get_async()
+            if user:
+                yield context.memcache_set(cache_key, user.key.urlsafe())
+        elif user.name != name:
+            # The cache key is case-folded, and holds the other User
+            user = yield cls.query(cls.name == name).get_async()
+        raise ndb.Return(user or keyed)
+
+    @classmethod
+    def create(cls, name, email=''):
+        """Creates a User in a transaction, unless a User with the name
+            already exists.
+        Returns:
+            The new User, or None if the name is taken"""
+        # Users not migrated yet are not covered by the transaction
+        if cls.get_by_name(name):
+            return None
+
+        @ndb.transactional
+        def _create():
+            key = cls.key_for_name(name)
+            if key.get():
+                return None
+            user = cls(key=key, name=name, email=email)
+            user.put()
+            return user
+        return _create()
+
 
 # ========== GAME ==========
+MEMCACHE_GAME_FORM = 'GAME_FORM_{}'
+MEMCACHE_GAME_HISTORY = 'GAME_HISTORY_{}'
+# Attempts of a Game transaction.  Transactions are optimistic: the commit
+# fails if the Game was written since it was read, and the transaction is
+# run again on the new state.  After the last attempt it fails with
+# TransactionFailedError.
+GAME_TRANSACTION_RETRIES = 5
+# History entries of the ways a Game can end other than a last move
+GAME_ENDINGS = {'canceled': 'Game canceled!',
+                'expired': 'Game expired!'}
+
+
+class Move(ndb.Model):
+    """A guess applied to a Game.  Stored in Game.moves under one letter
+    property names; the history message is rendered from it when needed."""
+    guess = ndb.StringProperty('g', required=True)
+    hit = ndb.BooleanProperty('h', required=True)
+    attempts_remaining = ndb.IntegerProperty('a', required=True)
+
+
 class Game(ndb.Model):
     """Game object"""
     word = ndb.StringProperty(required=True)
@@ -26,75 +119,218 @@ class Game(ndb.Model):
     guesses = ndb.StringProperty(repeated=True)
     user = ndb.KeyProperty(required=True, kind='User')
     difficulty = ndb.StringProperty(default='NORMAL')
+    # The moves that did not win the Game, in order
+    moves = ndb.LocalStructuredProperty(Move, repeated=True)
+    # A key of GAME_ENDINGS, if the Game did not end with a move
+    ending = ndb.StringProperty(indexed=False, choices=GAME_ENDINGS.keys())
+    # Rendered history of Games saved before moves existed; converted to
+    # moves when read
     history = ndb.StringProperty(repeated=True)
+    # Bit i is set once word[i] has been revealed
+    revealed = ndb.IntegerProperty(indexed=False)
+    # Bit n is set once the n-th letter of the alphabet has been guessed
+    guessed_letters = ndb.IntegerProperty(indexed=False)
+    # Incremented by every put; identifies the state of the Game
+    version = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    # Set when the Game is created and by every move; stale active Games
+    # are ended by the expire_games job
+    last_move = ndb.DateTimeProperty(auto_now_add=True)
+
+    def _pre_put_hook(self):
+        self.version += 1
+
+    @staticmethod
+    def invalidate_cache(*game_keys):
+        """Removes the cached responses of Games from memcache, with one
+            batch delete.  Called by the methods that rewrite existing
+            Games, once the writes are done; new Games have nothing
+            cached."""
+        cache_keys = []
+        for game_key in game_keys:
+            urlsafe = game_key.urlsafe()
+            cache_keys.extend([MEMCACHE_GAME_FORM.format(urlsafe),
+                               MEMCACHE_GAME_HISTORY.format(urlsafe)])
+        if cache_keys:
+            memcache.delete_multi(cache_keys)
+
+    def etag(self):
+        """Returns a tag that changes whenever the Game is written"""
+        return '{}.{}'.format(self.key.id(), self.version)
 
     @classmethod
-    def new_game(cls, user, difficulty='NORMAL'):
-        """Creates and returns a new game"""
+    def new_games(cls, user_names, difficulty='NORMAL'):
+        """Creates a new game for each named User.  The Users are fetched
+            with one batch get while the words are drawn, and the Games are
+            written with one batch put.
+        Returns:
+            (games, names that do not match a User).  Nothing is written if
+            any name does not match a User.
+        Raises:
+            ValueError: a name is blank; raised before any RPC is started
+        """
+        if not all(User.normalize_name(name).strip() for name in user_names):
+            raise ValueError('User names must not be blank')
+        user_keys = [User.key_for_name(name) for name in user_names]
+        users_future = ndb.get_multi_async(user_keys)
+        games = [cls._build(user_key, difficulty) for user_key in user_keys]
+        missing = []
+        for name, game, future in zip(user_names, games, users_future):
+            if future.get_result() is None:
+                # The User may not be keyed by name yet
+                user = User.get_by_name(name)
+                if user is None:
+                    missing.append(name)
+                else:
+                    game.user = user.key
+        if missing:
+            return [], missing
+        ndb.put_multi(games)
+        return games, []
+
+    @classmethod
+    def _build(cls, user, difficulty):
+        """Returns a new, unsaved game for a User key"""
         # determine word length based on difficulty selected
         word_length = get_word_length(getattr(GameDifficulty, difficulty))
-        # Get the word
-        url = ('http://randomword.setgetgo.com/get.php?len=%s'
-           % word_length)
-        word = urllib2.urlopen(url).read()
-        # uppercase the word
-        word = word.upper()
+        # Get the word from the bundled word bank
+        return cls._with_word(user, difficulty, words.get_word(word_length))
+
+    @classmethod
+    @ndb.tasklet
+    def _build_async(cls, user, difficulty):
+        """Asynchronous version of _build; returns a Future"""
+        word_length = get_word_length(getattr(GameDifficulty, difficulty))
+        word = yield words.get_word_async(word_length)
+        raise ndb.Return(cls._with_word(user, difficulty, word))
+
+    @classmethod
+    def _with_word(cls, user, difficulty, word):
+        """Returns a new, unsaved game of a word for a User key"""
         if len(word) < 4:
             raise ValueError('Unable to generate a word to guess!')
         # determine the number of incorrect guesses are allowed.
         attempts = get_attempts_allowed(getattr(GameDifficulty, difficulty))
 
-        game = Game(user=user,
+        return Game(user=user,
                     word=word,
                     attempts_allowed=attempts,
                     attempts_remaining=attempts,
                     game_over=False,
                     difficulty=str(difficulty).upper(),
                 )
-        game.put()
-        return game
 
-    def get_guess_status(self):
-        """This is a computed getter.
-            Represents the word with correct single letter guesses filled
-            in, and letters not yet guessed filled with a '_' character
-            (underscore).
-        """
-        val = ""
-        found = False
-        for c in self.word:
-            if val == self.word:
+    def _ensure_masks(self):
+        """Computes revealed and guessed_letters from guesses for Games
+            saved before they were stored.  They are saved with the next
+            put."""
+        if self.revealed is not None and self.guessed_letters is not None:
+            return
+        self.revealed = 0
+        self.guessed_letters = 0
+        for guess in self.guesses:
+            self.reveal(guess)
+
+    def _ensure_moves(self):
+        """Converts the history of Games saved before moves were stored,
+            by replaying their guesses.  The moves are saved, and the old
+            history removed, with the next put."""
+        if not self.history:
+            return
+        attempts_remaining = self.attempts_allowed
+        revealed = 0
+        solved = (1 << len(self.word)) - 1
+        self.moves = []
+        for guess in self.guesses:
+            revealed, hit = _reveal(self.word, revealed, guess)
+            if revealed == solved:
                 break
-            for guess in self.guesses:
-                if len(guess) == 1 and guess == c:
-                    val += c
-                    found = True
-                    break
-                elif len(guess) > 1 and guess == self.word:
-                    val = guess
-                    found = True
-                    break
-            if found:
-                found = False
+            if not hit:
+                attempts_remaining -= 1
+            self.moves.append(Move(guess=guess, hit=hit,
+                                   attempts_remaining=attempts_remaining))
+        for ending, entry in GAME_ENDINGS.iteritems():
+            if entry in self.history:
+                self.ending = ending
+        self.history = []
+
+    def get_history(self, start=0):
+        """Renders the Game's history, one message per move and one for
+            the ending of a canceled or expired Game.
+        Args:
+            :start<int>: the number of leading entries to leave out
+        Returns:
+            :<list of string>
+        """
+        self._ensure_moves()
+        history = []
+        revealed = 0
+        for i, move in enumerate(self.moves):
+            revealed, _ = _reveal(self.word, revealed, move.guess)
+            if i < start:
+                continue
+            msg = ''.join(c if revealed >> i & 1 else '_'
+                          for i, c in enumerate(self.word))
+            if not move.hit:
+                msg += ' Incorrect Guess!'
+            if move.attempts_remaining < 1:
+                msg = msg + ' Game over! The word was ' + self.word
             else:
-                val += "_"
-        return val
-
-    def is_guess_correct(self, guess):
-        """Helper function to quickly determine if a guess is contained
-            in the word
+                msg = msg + ' Keep Going!'
+            history.append('guess:' + move.guess + ', result:' + msg)
+        if self.ending and len(self.moves) >= start:
+            history.append(GAME_ENDINGS[self.ending])
+        return history
+
+    def get_hint(self):
+        """Returns (letter, candidate words) of words.get_hint for the
+            Game's guess status and guessed letters"""
+        return words.get_hint(self.get_guess_status(),
+                              [guess for guess in self.guesses
+                               if len(guess) == 1])
+
+    def has_guessed(self, guess):
+        """Returns True if the letter or word has already been guessed"""
+        self._ensure_masks()
+        if len(guess) == 1:
+            return bool(self.guessed_letters & _letter_bit(guess))
+        return guess in self.guesses
+
+    def reveal(self, guess):
+        """Reveals the positions of the word matched by a guess.
         Args:
-            :guess<string>: The user's guess
+            :guess<string>: an upper case letter or word
         Returns:
-            True if the guess id contained in the Game's word, False otherwise
+            True if the guess is a letter contained in the word, or the word
         """
-        return self.word.find(guess) >= 0
+        self._ensure_masks()
+        if len(guess) == 1:
+            self.guessed_letters |= _letter_bit(guess)
+        self.revealed, hit = _reveal(self.word, self.revealed, guess)
+        return hit
+
+    def is_solved(self):
+        """Returns True once every letter of the word has been revealed"""
+        self._ensure_masks()
+        return self.revealed == (1 << len(self.word)) - 1
 
-    def to_form(self, message=''):
-        """Returns a GameForm representation of the Game"""
+    def get_guess_status(self):
+        """This is a computed getter.
+            Represents the word with correct single letter guesses filled
+            in, and letters not yet guessed filled with a '_' character
+            (underscore).
+        """
+        self._ensure_masks()
+        return ''.join(c if self.revealed >> i & 1 else '_'
+                       for i, c in enumerate(self.word))
+
+    def to_form(self, message='', user=None):
+        """Returns a GameForm representation of the Game.  The Game's User is
+            fetched unless it is passed in."""
+        if user is None:
+            user = self.user.get()
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user.name
         # convert GameDifficulty string to Enum
         form.difficulty = getattr(GameDifficulty, getattr(self, 'difficulty'))
         form.attempts_remaining = self.attempts_remaining
@@ -102,20 +338,217 @@ class Game(ndb.Model):
         form.guesses = self.guesses
         form.guess_status = self.get_guess_status()
         form.message = message
+        form.etag = self.etag()
         return form
 
-    def end_game(self, won=False):
-        """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+    @classmethod
+    def to_forms(cls, games, message=''):
+        """Returns a GameForms representation of the given Games.  The Users
+            of all the Games are fetched with a single batch get."""
+        games = list(games)
+        users = get_users_by_key(game.user for game in games)
+        return GameForms(items=[game.to_form(message, users[game.user])
+                                for game in games])
+
+    def apply_move(self, guess):
+        """Applies a guess to the Game in memory, following the Hangman
+            rules.  Nothing is written.
+        Args:
+            :guess<string>: an upper case letter or word that has not been
+                guessed yet
+        Returns:
+            The message describing the result of the guess.  The game is
+            over when is_solved() is True or no attempts remain.
+        """
+        self._ensure_moves()
+        self.guesses.append(guess)
+        self.last_move = datetime.now()
+        hit = self.reveal(guess)
+        # A correct word, or the last missing letter, wins the game
+        if self.is_solved():
+            return 'You win! Word is: ' + self.word
+        msg = self.get_guess_status()
+        if not hit:
+            self.attempts_remaining -= 1
+            msg += ' Incorrect Guess!'
+        if self.attempts_remaining < 1:
+            msg = msg + ' Game over! The word was ' + self.word
+        else:
+            msg = msg + ' Keep Going!'
+        self.moves.append(Move(guess=guess, hit=hit,
+                               attempts_remaining=self.attempts_remaining))
+        return msg
+
+    @classmethod
+    def make_move(cls, game_key, guess):
+        """Applies a guess to a Game in a single transaction, which writes
+            the Game and, if the move ends it, its Score and UserStats.
+        Args:
+            :game_key<ndb.Key>: the Game's key
+            :guess<string>: an upper case letter or word
+        Returns:
+            (game, message, attempts_remaining before the move, True if the
+            Game was active before the move), or None if the Game does not
+            exist
+        """
+        result = cls.make_moves(game_key, [guess])
+        if result is None:
+            return None
+        game, messages, _, attempts_remaining, was_active = result
+        return game, messages[0], attempts_remaining, was_active
+
+    @classmethod
+    def make_moves(cls, game_key, guesses):
+        """Applies guesses in order to a Game, with the same rules as
+            make_move, stopping when the Game ends.  The Game is read and
+            written once, in a single transaction.
+        Args:
+            :game_key<ndb.Key>: the Game's key
+            :guesses<list of string>: upper case letters or words
+        Returns:
+            (game, the message of each guess applied, the history entries
+            added, attempts_remaining before the moves, True if the Game was
+            active before the moves), or None if the Game does not exist
+        """
+        result = cls._make_moves_async(game_key, guesses).get_result()
+        cls.invalidate_cache(game_key)
+        return result
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True, retries=GAME_TRANSACTION_RETRIES)
+    def _make_moves_async(cls, game_key, guesses):
+        game = yield game_key.get_async()
+        if game is None:
+            raise ndb.Return(None)
+        attempts_remaining = game.attempts_remaining
+        was_active = not game.game_over
+        game._ensure_moves()
+        moves_length = len(game.moves)
+        messages = []
+        changed = False
+        for guess in guesses:
+            if game.game_over:
+                messages.append('Game already over!')
+                break
+            # Check the user, has not already guessed this letter or word
+            if game.has_guessed(guess):
+                messages.append('You have already guessed this value.  '
+                                'Try something else!')
+                continue
+            messages.append(game.apply_move(guess))
+            changed = True
+            won = game.is_solved()
+            if won or game.attempts_remaining < 1:
+                yield game._end_game_async(won)
+                break
+        if changed and not game.game_over:
+            yield game.put_async()
+        # Moves never set the ending; the ending of a Game canceled or
+        # expired earlier was not added by this call
+        history = game.get_history(moves_length) if changed else []
+        raise ndb.Return(game, messages, history, attempts_remaining,
+                         was_active)
+
+    @classmethod
+    def cancel(cls, game_key):
+        """Cancels an active Game in a single transaction.
+        Returns:
+            (game, message, attempts_remaining before the cancel, True if the
+            Game was active before the cancel), or None if the Game does not
+            exist
+        """
+        result = cls._cancel_async(game_key).get_result()
+        cls.invalidate_cache(game_key)
+        return result
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True, retries=GAME_TRANSACTION_RETRIES)
+    def _cancel_async(cls, game_key):
+        game = yield game_key.get_async()
+        if game is None:
+            raise ndb.Return(None)
+        attempts_remaining = game.attempts_remaining
+        if game.game_over:
+            raise ndb.Return(game, 'Game is over. Cannot cancel game.',
+                             attempts_remaining, False)
+        game._ensure_moves()
+        game.ending = 'canceled'
+        yield game._end_game_async(False)
+        raise ndb.Return(game, 'Game canceled!', attempts_remaining, True)
+
+    @classmethod
+    def expire_multi(cls, game_keys, cutoff):
+        """Ends active Games whose last move was before cutoff, as losses.
+            Each Game is ended in its own transaction, and the transactions
+            run concurrently.  A Game moved since it was found is skipped.
+        Returns:
+            [(game, attempts_remaining before it ended)] of the Games ended
+        """
+        futures = [cls._expire_async(game_key, cutoff)
+                   for game_key in game_keys]
+        expired = [future.get_result() for future in futures]
+        expired = [result for result in expired if result]
+        cls.invalidate_cache(*[game.key for game, _ in expired])
+        return expired
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True, retries=GAME_TRANSACTION_RETRIES)
+    def _expire_async(cls, game_key, cutoff):
+        game = yield game_key.get_async()
+        if (game is None or game.game_over or game.last_move is None or
+                game.last_move >= cutoff):
+            raise ndb.Return(None)
+        attempts_remaining = game.attempts_remaining
+        game._ensure_moves()
+        game.ending = 'expired'
+        yield game._end_game_async(False)
+        raise ndb.Return(game, attempts_remaining)
+
+    @classmethod
+    def update_multi(cls, game_keys, change):
+        """Applies change(game) to Games and writes them, for jobs that
+            change Games outside of a move.  Each Game is read and written in
+            its own transaction, so a concurrent move is never overwritten:
+            if the Game is written meanwhile, the transaction is run again
+            and change is applied to the new state.  The transactions run
+            concurrently.
+        Returns:
+            the Games written"""
+        futures = [cls._update_async(game_key, change)
+                   for game_key in game_keys]
+        games = [future.get_result() for future in futures]
+        games = [game for game in games if game]
+        cls.invalidate_cache(*[game.key for game in games])
+        return games
+
+    @classmethod
+    @ndb.transactional_tasklet(retries=GAME_TRANSACTION_RETRIES)
+    def _update_async(cls, game_key, change):
+        game = yield game_key.get_async()
+        if game is None:
+            raise ndb.Return(None)
+        change(game)
+        yield game.put_async()
+        raise ndb.Return(game)
+
+    @ndb.tasklet
+    def _end_game_async(self, won):
+        """Ends the game and writes the Game, its Score and the User's
+        UserStats with one batch put.  Must run in a transaction.  A win is
+        submitted to the Leaderboard by a task enqueued with the commit."""
         self.game_over = True
-        self.put()
         # Add the game to the score 'board'
         score = Score(user=self.user, game=self.key,
                       date=date.today(), won=won,
                       guesses=self.attempts_allowed - self.attempts_remaining,
                       difficulty=self.difficulty
                       )
-        score.put()
+        stats = yield UserStats.get_or_new_async(self.user, self.difficulty)
+        stats.record(won)
+        yield ndb.put_multi_async([self, score, stats])
+        if won:
+            deferred.defer(Leaderboard.submit, score, _transactional=True)
+        raise ndb.Return(score)
 
 
 class GameDifficulty(messages.Enum):
@@ -136,11 +569,231 @@ class Score(ndb.Model):
     guesses = ndb.IntegerProperty(required=True)
     difficulty = ndb.StringProperty(required=True)
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
+    def to_form(self, user=None):
+        """Returns a ScoreForm representation of the Score.  The Score's User
+            is fetched unless it is passed in."""
+        if user is None:
+            user = self.user.get()
+        return ScoreForm(user_name=user.name, won=self.won,
                          date=str(self.date), guesses=self.guesses,
                          difficulty=getattr(GameDifficulty, self.difficulty))
 
+    @classmethod
+    def to_forms(cls, scores):
+        """Returns a ScoreForms representation of the given Scores.  The
+            Users of all the Scores are fetched with a single batch get."""
+        scores = list(scores)
+        users = get_users_by_key(score.user for score in scores)
+        return ScoreForms(items=[score.to_form(users[score.user])
+                                 for score in scores])
+
+
+# ========== DAILY SCORE AGGREGATE ==========
+class DailyScoreAggregate(ndb.Model):
+    """The totals of a User's Scores of one day and GameDifficulty.  Old
+    losing Scores are folded into these by the compact_scores job and
+    deleted; winning Scores are kept.
+    The entity is a child of the User, keyed by the date and difficulty."""
+    user = ndb.KeyProperty(required=True, kind='User')
+    date = ndb.DateProperty(required=True)
+    difficulty = ndb.StringProperty(required=True)
+    games = ndb.IntegerProperty(required=True, default=0)
+    wins = ndb.IntegerProperty(required=True, default=0)
+    guesses = ndb.IntegerProperty(required=True, default=0)
+
+    @classmethod
+    def key_for(cls, user_key, day, difficulty):
+        """Returns the key of a User's aggregate of a day and difficulty"""
+        return ndb.Key(cls, '{}:{}'.format(day.isoformat(), difficulty),
+                       parent=user_key)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def fold(cls, user_key, score_keys):
+        """Adds Scores of one User to their aggregates and deletes them, in
+            one transaction.  Scores already deleted are skipped, so a
+            retried fold does not count a Score twice.  At most 20 Scores
+            can be folded at once.
+        Returns:
+            the number of Scores folded"""
+        scores = [score for score in ndb.get_multi(score_keys) if score]
+        keys = [cls.key_for(user_key, score.date, score.difficulty)
+                for score in scores]
+        aggregates = {}
+        for key, aggregate in zip(keys, ndb.get_multi(keys)):
+            aggregates[key] = aggregate
+        for key, score in zip(keys, scores):
+            if aggregates[key] is None:
+                aggregates[key] = cls(key=key, user=user_key, date=score.date,
+                                      difficulty=score.difficulty)
+            aggregate = aggregates[key]
+            aggregate.games += 1
+            aggregate.wins += 1 if score.won else 0
+            aggregate.guesses += score.guesses
+        ndb.put_multi(aggregates.values())
+        ndb.delete_multi([score.key for score in scores])
+        return len(scores)
+
+
+# ========== USER STATS ==========
+class UserStats(ndb.Model):
+    """Running totals of a User's games at one GameDifficulty.  Kept up to
+    date by Game._end_game_async so that rankings do not have to scan
+    Scores.  The entity is a child of the User, keyed by the difficulty."""
+    user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty(required=True)
+    difficulty = ndb.StringProperty(required=True)
+    games = ndb.IntegerProperty(required=True, default=0)
+    wins = ndb.IntegerProperty(required=True, default=0)
+    win_percentage = ndb.FloatProperty(required=True, default=0.0)
+
+    @classmethod
+    def key_for(cls, user_key, difficulty):
+        """Returns the key of a User's UserStats for a difficulty"""
+        return ndb.Key(cls, str(difficulty), parent=user_key)
+
+    @classmethod
+    @ndb.tasklet
+    def get_or_new_async(cls, user_key, difficulty):
+        """Returns the User's UserStats for a difficulty, or a new (unsaved)
+            one with no games recorded"""
+        key = cls.key_for(user_key, difficulty)
+        stats, user = yield key.get_async(), user_key.get_async()
+        if stats is None:
+            stats = cls(key=key, user=user_key, user_name=user.name,
+                        difficulty=str(difficulty))
+        raise ndb.Return(stats)
+
+    def record(self, won):
+        """Adds a finished game to the totals"""
+        self.set_totals(self.games + 1, self.wins + (1 if won else 0))
+
+    def set_totals(self, games, wins):
+        """Sets the number of games played and won"""
+        self.games = games
+        self.wins = wins
+        self.win_percentage = round(float(wins)/games*100, 2) if games else 0.0
+
+    def to_form(self):
+        """Returns a RankingForm representation of the UserStats"""
+        return RankingForm(user_name=self.user_name,
+                           difficulty=getattr(GameDifficulty, self.difficulty),
+                           win_percentage=self.win_percentage,
+                           wins=self.wins)
+
+
+# ========== LEADERBOARD ==========
+LEADERBOARD_SIZE = 100
+MEMCACHE_LEADERBOARD = 'LEADERBOARD_{}'
+# Seconds a cached Leaderboard is kept.  submit removes it from memcache,
+# but a reader that read the datastore before the submit committed can
+# still cache the older board; it is replaced once it expires.
+LEADERBOARD_CACHE_TIME = 10 * 60
+
+
+class LeaderboardEntry(ndb.Model):
+    """A winning Score on a Leaderboard"""
+    game = ndb.KeyProperty(required=True, kind='Game')
+    user_name = ndb.StringProperty(required=True)
+    date = ndb.DateProperty(required=True)
+    guesses = ndb.IntegerProperty(required=True)
+
+    def rank(self):
+        """Sort key: fewest guesses first, then the most recent"""
+        return (self.guesses, -self.date.toordinal())
+
+
+class Leaderboard(ndb.Model):
+    """The best LEADERBOARD_SIZE winning Scores of one GameDifficulty, best
+    first.  Keyed by the difficulty and cached in memcache, so high scores
+    can be served without querying Scores.  Game._end_game_async submits
+    every win; the Score query is only used to build a missing
+    Leaderboard."""
+    entries = ndb.LocalStructuredProperty(LeaderboardEntry, repeated=True)
+
+    @classmethod
+    def get_leaderboard(cls, difficulty):
+        """Returns the Leaderboard of a difficulty from memcache, the
+            datastore, or by building it from the Scores, in that order.
+            A board read from the datastore is only added to memcache if no
+            other request cached one meanwhile."""
+        cache_key = MEMCACHE_LEADERBOARD.format(difficulty)
+        leaderboard = memcache.get(cache_key)
+        if leaderboard is None:
+            leaderboard = ndb.Key(cls, str(difficulty)).get()
+            if leaderboard is None:
+                leaderboard = cls._build(difficulty)
+            memcache.add(cache_key, leaderboard, time=LEADERBOARD_CACHE_TIME)
+        return leaderboard
+
+    @classmethod
+    def _build(cls, difficulty):
+        """Builds the Leaderboard of a difficulty from the Scores.  It is
+            only saved if still missing, so it never overwrites a board a
+            concurrent submit created; that stored board is returned
+            instead."""
+        scores = Score.query(Score.difficulty == str(difficulty),
+                             Score.won == True)
+        scores = scores.order(Score.guesses, -Score.date)
+        scores = scores.fetch(LEADERBOARD_SIZE)
+        users = get_users_by_key(score.user for score in scores)
+        leaderboard = cls(id=str(difficulty), entries=[
+            LeaderboardEntry(game=score.game,
+                             user_name=users[score.user].name,
+                             date=score.date, guesses=score.guesses)
+            for score in scores])
+
+        @ndb.transactional
+        def _create():
+            stored = leaderboard.key.get()
+            if stored is not None:
+                return stored
+            leaderboard.put()
+            return leaderboard
+        return _create()
+
+    @classmethod
+    def submit(cls, score):
+        """Adds a winning Score to its difficulty's Leaderboard if it
+            ranks among the best LEADERBOARD_SIZE"""
+        entry = LeaderboardEntry(game=score.game,
+                                 user_name=score.user.get().name,
+                                 date=score.date, guesses=score.guesses)
+        # Most wins do not qualify; check against the cached board first
+        if not cls.get_leaderboard(score.difficulty).qualifies(entry):
+            return
+
+        @ndb.transactional
+        def _submit():
+            key = ndb.Key(cls, score.difficulty)
+            leaderboard = key.get() or cls(key=key)
+            if leaderboard.qualifies(entry):
+                leaderboard.entries.append(entry)
+                leaderboard.entries.sort(key=LeaderboardEntry.rank)
+                del leaderboard.entries[LEADERBOARD_SIZE:]
+                leaderboard.put()
+        _submit()
+        # The next reader caches the new board from the datastore
+        memcache.delete(MEMCACHE_LEADERBOARD.format(score.difficulty))
+
+    def qualifies(self, entry):
+        """Returns True if entry is not on the Leaderboard yet and ranks
+            among the best LEADERBOARD_SIZE"""
+        if any(e.game == entry.game for e in self.entries):
+            return False
+        return (len(self.entries) < LEADERBOARD_SIZE or
+                entry.rank() < self.entries[-1].rank())
+
+    def to_forms(self, difficulty, number_of_results):
+        """Returns a ScoreForms representation of the best
+            number_of_results entries"""
+        difficulty = getattr(GameDifficulty, str(difficulty))
+        return ScoreForms(items=[
+            ScoreForm(user_name=entry.user_name, won=True,
+                      date=str(entry.date), guesses=entry.guesses,
+                      difficulty=difficulty)
+            for entry in self.entries[:number_of_results]])
+
 
 # ========== FORMS ==========
 class GameForm(messages.Message):
@@ -153,11 +806,13 @@ class GameForm(messages.Message):
     guess_status = messages.StringField(6, required=True)
     user_name = messages.StringField(7, required=True)
     difficulty = messages.EnumField('GameDifficulty', 8)
+    etag = messages.StringField(9)
 
 
 class GameForms(messages.Message):
     """Return multiple GameForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class NewGameForm(messages.Message):
@@ -166,11 +821,40 @@ class NewGameForm(messages.Message):
     difficulty = messages.EnumField('GameDifficulty', 2)
 
 
+class NewGamesForm(messages.Message):
+    """Used to create a game for each of several users"""
+    user_names = messages.StringField(1, repeated=True)
+    difficulty = messages.EnumField('GameDifficulty', 2)
+
+
+class GameKeysForm(messages.Message):
+    """Return the urlsafe keys of several games"""
+    urlsafe_keys = messages.StringField(1, repeated=True)
+
+
 class MakeMoveForm(messages.Message):
     """Used to make a move in an existing game"""
     guess = messages.StringField(1, required=True)
 
 
+class MakeMovesForm(messages.Message):
+    """Used to make several moves in an existing game"""
+    guesses = messages.StringField(1, repeated=True)
+
+
+class MoveResultForm(messages.Message):
+    """The result of one move"""
+    guess = messages.StringField(1, required=True)
+    message = messages.StringField(2, required=True)
+
+
+class MovesForm(messages.Message):
+    """Return the results of several moves and the resulting game state"""
+    game = messages.MessageField(GameForm, 1, required=True)
+    results = messages.MessageField(MoveResultForm, 2, repeated=True)
+    history = messages.StringField(3, repeated=True)
+
+
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     user_name = messages.StringField(1, required=True)
@@ -184,6 +868,7 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class RankingForm(messages.Message):
@@ -198,11 +883,20 @@ class RankingForm(messages.Message):
 class RankingForms(messages.Message):
     """Return multiple RankingForms"""
     items = messages.MessageField(RankingForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class HistoryForm(messages.Message):
     """Return Game History Information"""
     history = messages.StringField(1, repeated=True)
+    etag = messages.StringField(2)
+
+
+class HintForm(messages.Message):
+    """The suggested next letter of a Game"""
+    letter = messages.StringField(1)
+    candidates = messages.IntegerField(2, required=True)
+    message = messages.StringField(3, required=True)
 
 
 class StringMessage(messages.Message):
@@ -210,7 +904,43 @@ class StringMessage(messages.Message):
     message = messages.StringField(1, required=True)
 
 
+# ========== HELPER FUNCTIONS ==========
+def get_users_by_key(user_keys):
+    """
+    Resolves User keys with a single batch get, so that serializing a list of
+    Games or Scores costs one datastore RPC instead of one per entity.
+    Args:
+        :user_keys <iterable of ndb.Key>: may contain duplicates
+    Returns:
+        :<dict> mapping each distinct User key to its User entity
+    """
+    keys = list(set(user_keys))
+    return dict(zip(keys, ndb.get_multi(keys)))
+
+
 # ========== GAME HELPER FUNCTIONS ==========
+def _letter_bit(letter):
+    """Returns the Game.guessed_letters bit of an upper case letter"""
+    return 1 << (ord(letter) - ord('A'))
+
+
+def _reveal(word, revealed, guess):
+    """Applies a guess to a Game.revealed mask of a word.
+    Returns:
+        (the new mask, True if the guess is a letter of the word or the word)
+    """
+    if len(guess) > 1:
+        if guess != word:
+            return revealed, False
+        return (1 << len(word)) - 1, True
+    hit = False
+    for i, c in enumerate(word):
+        if c == guess:
+            revealed |= 1 << i
+            hit = True
+    return revealed, hit
+
+
 def get_attempts_allowed(difficulty):
     """
     This method determines the number of incorrect guesses
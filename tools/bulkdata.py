@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+"""bulkdata.py - Bulk export and import of Users, Games and Scores.
+
+Connects to a running application (dev_appserver or App Engine) through
+remote_api and moves the three kinds as newline-delimited JSON, one record
+per line, Users first, then Games, then Scores:
+
+    {"kind": "User", "name": "pacman", "email": "pacman@example.com"}
+    {"kind": "Game", "id": 5629499534213120, "user": "pacman", ...}
+    {"kind": "Score", "id": 5066549580791808, "user": "pacman",
+     "game": 5629499534213120, ...}
+
+References are remapped so that a dump loads into any application: Users
+are referred to by name (and keyed by name on import, which also migrates
+Users with datastore allocated ids), and Games and Scores keep their ids,
+whose range is reserved in the target so new entities cannot collide with
+them.  An import stops, before writing anything of the wave, if the target
+already holds a Game or Score with one of the ids: it never overwrites
+unrelated entities.  Imports are idempotent (every put has a complete key)
+and record the number of lines written in FILE.progress, so an interrupted
+import resumes where it stopped; the first wave of a resumed import may
+have been written by the interrupted run, and is not checked.  An export
+resumes from the cursor saved in FILE.progress.
+
+UserStats, Leaderboards and the active Game counters are derived data.  An
+import deletes the Leaderboards (and their memcache entries) once every
+line is written, so each is rebuilt from the Scores when next read; run
+/tasks/backfill_user_stats and /tasks/rebuild_game_counters after it.
+DailyScoreAggregates are not moved, so the stats rebuilt in the target only
+count the Scores still within the compaction retention window.
+
+Usage:
+    python tools/bulkdata.py --sdk ~/google_appengine \\
+        --server localhost:8080 export dump.ndjson
+    python tools/bulkdata.py --sdk ~/google_appengine \\
+        --server localhost:8080 import dump.ndjson --parallelism 8
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KINDS = ['User', 'Game', 'Score']
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# Seconds between progress lines
+REPORT_INTERVAL = 5
+
+
+def setup_environment(sdk):
+    """Puts the App Engine SDK and the application on sys.path"""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT_DIR)
+
+
+def connect(server):
+    """Routes the API calls of this process to the application's
+    remote_api handler.  A dev_appserver (localhost) accepts any login."""
+    from google.appengine.ext.remote_api import remote_api_stub
+    if server.startswith('localhost') or server.startswith('127.0.0.1'):
+        remote_api_stub.ConfigureRemoteApi(
+            None, '/_ah/remote_api', lambda: ('admin@example.com', ''),
+            servername=server, secure=False)
+    else:
+        remote_api_stub.ConfigureRemoteApiForOAuth(server, '/_ah/remote_api')
+
+
+class Progress(object):
+    """Reports rows per second, and keeps the resume state in a file"""
+
+    def __init__(self, path):
+        self.path = path + '.progress'
+        self.start = time.time()
+        self.reported = self.start
+        self.rows = 0
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, state):
+        # Written to a new file and renamed, so an interruption never
+        # leaves a partial state
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(self.path + '.tmp', self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def add(self, rows, label):
+        self.rows += rows
+        now = time.time()
+        if now - self.reported >= REPORT_INTERVAL:
+            self.reported = now
+            self.report(label)
+
+    def report(self, label):
+        elapsed = max(time.time() - self.start, 0.001)
+        sys.stderr.write('{}: {} rows in {:.1f}s ({:.0f} rows/sec)\n'.format(
+            label, self.rows, elapsed, self.rows / elapsed))
+
+
+# ========== EXPORT ==========
+def user_record(user):
+    return {'kind': 'User', 'name': user.name, 'email': user.email}
+
+
+def game_record(game, user):
+    # Games saved before moves existed are converted first
+    game._ensure_moves()
+    return {'kind': 'Game', 'id': game.key.id(), 'user': user.name,
+            'word': game.word, 'difficulty': game.difficulty,
+            'attempts_allowed': game.attempts_allowed,
+            'attempts_remaining': game.attempts_remaining,
+            'game_over': game.game_over, 'guesses': game.guesses,
+            'moves': [[move.guess, move.hit, move.attempts_remaining]
+                      for move in game.moves],
+            'ending': game.ending,
+            'last_move': game.last_move.strftime(DATETIME_FORMAT)
+            if game.last_move else None}
+
+
+def score_record(score, user):
+    return {'kind': 'Score', 'id': score.key.id(), 'user': user.name,
+            'game': score.game.id(), 'date': score.date.isoformat(),
+            'won': score.won, 'guesses': score.guesses,
+            'difficulty': score.difficulty}
+
+
+def export(path, batch_size):
+    """Writes every User, Game and Score to path, resuming an interrupted
+    export of the same file"""
+    from google.appengine.ext import ndb
+    from models import User, Game, Score, get_users_by_key
+
+    progress = Progress(path)
+    state = progress.load()
+    models = {'User': User, 'Game': Game, 'Score': Score}
+    kind_index = KINDS.index(state.get('kind', KINDS[0]))
+    cursor = state.get('cursor')
+    with open(path, 'ab' if state else 'wb') as out:
+        # Drop any lines written after the last saved state
+        out.truncate(state.get('offset', 0))
+        out.seek(0, os.SEEK_END)
+        for kind in KINDS[kind_index:]:
+            more = True
+            while more:
+                entities, next_cursor, more = \
+                    models[kind].query().fetch_page(
+                        batch_size,
+                        start_cursor=ndb.Cursor(urlsafe=cursor)
+                        if cursor else None)
+                if kind == 'User':
+                    records = [user_record(user) for user in entities]
+                else:
+                    users = get_users_by_key(entity.user
+                                             for entity in entities)
+                    to_record = game_record if kind == 'Game' else \
+                        score_record
+                    records = [to_record(entity, users[entity.user])
+                               for entity in entities
+                               if users[entity.user] is not None]
+                out.write(''.join(json.dumps(record, sort_keys=True) + '\n'
+                                  for record in records))
+                out.flush()
+                more = more and next_cursor is not None
+                if more:
+                    cursor = next_cursor.urlsafe()
+                    progress.save({'kind': kind, 'cursor': cursor,
+                                   'offset': out.tell()})
+                progress.add(len(records), 'export ' + kind)
+                ndb.get_context().clear_cache()
+            cursor = None
+            if kind != KINDS[-1]:
+                progress.save({'kind': KINDS[KINDS.index(kind) + 1],
+                               'cursor': None, 'offset': out.tell()})
+    progress.clear()
+    progress.report('export')
+
+
+# ========== IMPORT ==========
+def to_entity(record):
+    """Returns the entity of a record, with its keys remapped to this
+    application"""
+    from google.appengine.ext import ndb
+    from models import User, Game, Score, Move
+
+    kind = record['kind']
+    if kind == 'User':
+        return User(key=User.key_for_name(record['name']),
+                    name=record['name'], email=record['email'])
+    user_key = User.key_for_name(record['user'])
+    if kind == 'Game':
+        return Game(key=ndb.Key(Game, record['id']), user=user_key,
+                    word=record['word'], difficulty=record['difficulty'],
+                    attempts_allowed=record['attempts_allowed'],
+                    attempts_remaining=record['attempts_remaining'],
+                    game_over=record['game_over'],
+                    guesses=record['guesses'],
+                    moves=[Move(guess=guess, hit=hit,
+                                attempts_remaining=attempts_remaining)
+                           for guess, hit, attempts_remaining
+                           in record['moves']],
+                    ending=record['ending'],
+                    last_move=datetime.strptime(record['last_move'],
+                                                DATETIME_FORMAT)
+                    if record['last_move'] else None)
+    if kind == 'Score':
+        return Score(key=ndb.Key(Score, record['id']), user=user_key,
+                     game=ndb.Key(Game, record['game']),
+                     date=datetime.strptime(record['date'],
+                                            '%Y-%m-%d').date(),
+                     won=record['won'], guesses=record['guesses'],
+                     difficulty=record['difficulty'])
+    raise ValueError('Unknown kind: {}'.format(kind))
+
+
+def existing_keys(records):
+    """Returns the keys of the Game and Score records of a batch that
+    already exist in this application; runs in a pool thread"""
+    from google.appengine.ext import ndb
+    keys = [ndb.Key(record['kind'], record['id']) for record in records
+            if record['kind'] != 'User']
+    entities = ndb.get_multi(keys, use_cache=False, use_memcache=False)
+    return [key for key, entity in zip(keys, entities) if entity]
+
+
+def put_batch(records):
+    """Writes a batch of records with one put_multi; runs in a pool
+    thread, with its own ndb context"""
+    from google.appengine.ext import ndb
+    entities = [to_entity(record) for record in records]
+    ndb.put_multi(entities, use_cache=False)
+    ndb.get_context().clear_cache()
+    return len(entities)
+
+
+def reserve_ids(max_ids):
+    """Reserves the imported Game and Score ids, so ids allocated later
+    cannot reuse them"""
+    from models import Game, Score
+    for model in (Game, Score):
+        if max_ids.get(model.__name__):
+            model.allocate_ids(max=max_ids[model.__name__])
+
+
+def reset_leaderboards():
+    """Deletes the Leaderboards and their memcache entries; put_batch does
+    not submit the imported wins, so the next reader of each difficulty
+    rebuilds its board from the Scores"""
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+    from models import Leaderboard, GameDifficulty, MEMCACHE_LEADERBOARD
+    difficulties = list(GameDifficulty.names())
+    ndb.delete_multi([ndb.Key(Leaderboard, difficulty)
+                      for difficulty in difficulties])
+    memcache.delete_multi([MEMCACHE_LEADERBOARD.format(difficulty)
+                           for difficulty in difficulties])
+
+
+def load(path, batch_size, parallelism):
+    """Writes every record of path, parallelism batches at a time,
+    resuming an interrupted import of the same file"""
+    progress = Progress(path)
+    state = progress.load()
+    done = state.get('lines', 0)
+    max_ids = state.get('max_ids', {})
+    resumed = bool(state)
+    pool = ThreadPool(parallelism)
+    with open(path, 'rb') as f:
+        lines = itertools.islice(f, done, None)
+        while True:
+            # One wave: parallelism batches written concurrently.  The
+            # state is saved once the whole wave is written, so a resumed
+            # import rewrites at most one wave.
+            wave = list(itertools.islice(lines, batch_size * parallelism))
+            if not wave:
+                break
+            records = [json.loads(line) for line in wave if line.strip()]
+            for record in records:
+                if record['kind'] != 'User':
+                    max_ids[record['kind']] = max(
+                        max_ids.get(record['kind'], 0), record['id'])
+            batches = [records[i:i + batch_size]
+                       for i in range(0, len(records), batch_size)]
+            if not resumed:
+                existing = sum(pool.map(existing_keys, batches), [])
+                if existing:
+                    pool.close()
+                    raise SystemExit(
+                        'The target already holds {} of the Games and Scores '
+                        'of lines {}-{}, e.g. {}; nothing of them was '
+                        'written.  Import into an application without '
+                        'them.'.format(len(existing), done + 1,
+                                       done + len(wave),
+                                       ', '.join(str(key) for key
+                                                 in existing[:5])))
+            resumed = False
+            pool.map(put_batch, batches)
+            done += len(wave)
+            progress.save({'lines': done, 'max_ids': max_ids})
+            progress.add(len(records), 'import')
+    pool.close()
+    reserve_ids(max_ids)
+    reset_leaderboards()
+    progress.clear()
+    progress.report('import')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('GAE_SDK'),
+                        help='path of the App Engine Python SDK '
+                             '(default: $GAE_SDK)')
+    parser.add_argument('--server', default='localhost:8080',
+                        help='host of the application (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='entities per query page or put_multi '
+                             '(default: %(default)s)')
+    parser.add_argument('--parallelism', type=int, default=4,
+                        help='put_multi batches written concurrently '
+                             '(default: %(default)s)')
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('file')
+    args = parser.parse_args(argv)
+    if not args.sdk:
+        parser.error('--sdk or $GAE_SDK is required')
+    if not 0 < args.batch_size <= 500:
+        parser.error('--batch-size must be between 1 and 500')
+
+    setup_environment(args.sdk)
+    connect(args.server)
+    if args.command == 'export':
+        export(args.file, args.batch_size)
+    else:
+        load(args.file, args.batch_size, args.parallelism)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,7 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 import endpoints
 from models import GameDifficulty
@@ -10,17 +11,17 @@ GAME_DIFFICULTY_VALUE_ERROR_MESSAGE = \
     'Attribute error, parameter: difficulty.  ' \
     'Valid values: EASY, NORMAL, HARD, EXPERT'
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+MAX_PAGE_SIZE = 100
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that a urlsafe key string represents, without
+        fetching the entity. Raises an error if the key String is malformed
+        or the key is of the incorrect kind
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The ndb.Key
     Raises:
         ValueError:"""
     try:
@@ -32,13 +33,9 @@ def get_by_urlsafe(urlsafe, model):
             raise endpoints.BadRequestException('Invalid Key')
         else:
             raise
-
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
+    if key.kind() != model._get_kind():
         raise ValueError('Incorrect Kind')
-    return entity
+    return key
 
 
 def validateGameDifficultyValue(request, required=False):
@@ -78,6 +75,49 @@ def validateGameDifficultyValue(request, required=False):
             GAME_DIFFICULTY_VALUE_ERROR_MESSAGE)
     return difficulty
 
+def get_cursor(urlsafe):
+    """Returns an ndb Cursor for a urlsafe cursor string, as passed back to
+        clients in next_cursor.
+    Args:
+        urlsafe: A urlsafe cursor string, or None
+    Returns:
+        The Cursor, or None if no cursor string was given.
+    Raises:
+        BadRequestException: the cursor string is malformed"""
+    if not urlsafe:
+        return None
+    try:
+        return ndb.Cursor(urlsafe=urlsafe)
+    except datastore_errors.BadValueError:
+        raise endpoints.BadRequestException('Invalid cursor')
+
+
+def get_next_cursor(cursor, more):
+    """Returns the urlsafe string of the cursor returned by fetch_page, or
+        None if there are no more results"""
+    if more and cursor:
+        return cursor.urlsafe()
+    return None
+
+
+def validateUserName(user_name):
+    """Returns user_name if it is not blank.  Raises a BadRequestException
+        otherwise."""
+    if user_name is None or not user_name.strip():
+        raise endpoints.BadRequestException(
+            'The request is missing a user_name!')
+    return user_name
+
+
+def validatePageSize(page_size):
+    """Returns page_size as an int if it is between 1 and MAX_PAGE_SIZE.
+        Raises a BadRequestException otherwise."""
+    if page_size is None or not 0 < int(page_size) <= MAX_PAGE_SIZE:
+        raise endpoints.BadRequestException(
+            'Page size must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    return int(page_size)
+
+
 def validateEmail(email):
     return re.match(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)",
         email)
@@ -0,0 +1,259 @@
+"""words.py - Word bank used to pick the word to guess for a new Game.
+
+The corpus is bundled with the application (words.txt, one upper case word
+per line) and is loaded lazily, once per instance, the first time a word is
+requested.  Words are packed per length into a single fixed-width string, so
+picking a random word of a given length is a constant time slice and does not
+require any network I/O.
+
+Hints are answered from a per-length index of the corpus: for each position
+and letter, a bitset (a Python int, bit n standing for the n-th word of that
+length) of the words with that letter there.  The words matching a Game's
+guess status are found with a few ANDs, and the best letter to guess is the
+one found in the most of them.  Hints are memoized per pattern in an LRU
+cache."""
+
+import collections
+import os
+import random
+import threading
+import urllib2
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+WORDS_FILE = os.path.join(os.path.dirname(__file__), 'words.txt')
+REMOTE_WORDS_URL = 'http://randomword.setgetgo.com/get.php?len=%s'
+REMOTE_WORDS_DEADLINE = 5
+# Patterns whose hints are memoized per instance
+HINT_CACHE_SIZE = 2048
+# Fallback letter order when the corpus has no word of a length
+LETTER_FREQUENCY = 'ETAOINSHRDLCUMWFGYPBVKJXQZ'
+
+# The remote word generator is bypassed unless explicitly enabled, so the
+# application (and anything running it under the testbed) works offline.
+USE_REMOTE_WORDS = os.environ.get('HANGMAN_REMOTE_WORDS', '') == '1'
+
+_lock = threading.Lock()
+_words_by_length = None
+_indexes = {}
+
+
+def _load_words():
+    """Returns a dict mapping word length to a packed string containing every
+        corpus word of that length.  The corpus is read on first use only."""
+    global _words_by_length
+    if _words_by_length is None:
+        with _lock:
+            if _words_by_length is None:
+                buckets = {}
+                with open(WORDS_FILE) as f:
+                    for line in f:
+                        word = line.strip().upper()
+                        if word.isalpha():
+                            buckets.setdefault(len(word), []).append(word)
+                _words_by_length = dict(
+                    (length, ''.join(words))
+                    for length, words in buckets.iteritems())
+    return _words_by_length
+
+
+def preload():
+    """Loads the corpus now instead of on first use"""
+    _load_words()
+
+
+def get_local_word(word_length):
+    """Returns a random word of word_length characters from the bundled
+        corpus.
+    Args:
+        :word_length <Int>: the length of the word
+    Returns:
+        :<String> an upper case word
+    Raises:
+        ValueError: the corpus has no word of the requested length"""
+    packed = _load_words().get(word_length)
+    if not packed:
+        raise ValueError('No word of length {} available'.format(word_length))
+    start = random.randrange(len(packed) // word_length) * word_length
+    return packed[start:start + word_length]
+
+
+def _check_remote_word(content, word_length):
+    """Returns the upper case word of a remote generator response, or None
+        if it is not a word of word_length letters"""
+    word = content.strip().upper()
+    if len(word) != word_length or not word.isalpha():
+        return None
+    return word
+
+
+def get_remote_word(word_length):
+    """Returns a random word of word_length characters from the remote
+        word generator at randomword.setgetgo.com, or None if the response
+        is not such a word"""
+    response = urllib2.urlopen(REMOTE_WORDS_URL % word_length,
+                               timeout=REMOTE_WORDS_DEADLINE)
+    return _check_remote_word(response.read(), word_length)
+
+
+def get_word(word_length):
+    """Returns a random upper case word of word_length characters.  The
+        bundled corpus is used unless USE_REMOTE_WORDS is set, in which case
+        the remote generator is tried first; any failure of it falls back to
+        the corpus."""
+    if USE_REMOTE_WORDS:
+        try:
+            word = get_remote_word(word_length)
+        except Exception:
+            # URLError, a socket timeout, a malformed response...
+            word = None
+        if word:
+            return word
+    return get_local_word(word_length)
+
+
+@ndb.tasklet
+def get_word_async(word_length):
+    """Asynchronous version of get_word; returns a Future.  The remote
+        generator, when enabled, is called with an asynchronous urlfetch so
+        that it runs concurrently with other RPCs."""
+    if USE_REMOTE_WORDS:
+        try:
+            result = yield ndb.get_context().urlfetch(
+                REMOTE_WORDS_URL % word_length,
+                deadline=REMOTE_WORDS_DEADLINE)
+        except urlfetch.Error:
+            result = None
+        if result is not None and result.status_code == 200:
+            word = _check_remote_word(result.content, word_length)
+            if word:
+                raise ndb.Return(word)
+    raise ndb.Return(get_local_word(word_length))
+
+
+class _LRUCache(object):
+    """A mapping of at most size items that evicts the least recently used
+    item.  Safe to use from several threads."""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+_hints = _LRUCache(HINT_CACHE_SIZE)
+
+
+class _LengthIndex(object):
+    """Letter-position bitsets over the corpus words of one length"""
+
+    def __init__(self, packed, length):
+        count = len(packed) // length
+        self.all = (1 << count) - 1
+        # at[i][letter]: the words with letter at position i
+        self.at = []
+        for i in range(length):
+            bits = {}
+            for n in range(count):
+                bits.setdefault(packed[n * length + i], []).append(n)
+            self.at.append(dict((letter, _bitset(positions, count))
+                                for letter, positions in bits.iteritems()))
+        # contains[letter]: the words with letter at any position
+        self.contains = {}
+        for at in self.at:
+            for letter, bitset in at.iteritems():
+                self.contains[letter] = self.contains.get(letter, 0) | bitset
+
+    def candidates(self, pattern, guessed):
+        """Returns the bitset of the words that match a guess status, where
+        the positions still '_' hold none of the guessed letters"""
+        candidates = self.all
+        for i, c in enumerate(pattern):
+            at = self.at[i]
+            if c != '_':
+                candidates &= at.get(c, 0)
+            else:
+                for letter in guessed:
+                    candidates &= ~at.get(letter, 0)
+            if not candidates:
+                break
+        return candidates
+
+
+def _bitset(positions, count):
+    """Returns an int with the bits of positions set"""
+    bits = ['0'] * count
+    for n in positions:
+        bits[count - 1 - n] = '1'
+    return int(''.join(bits), 2)
+
+
+def _popcount(bitset):
+    return bin(bitset).count('1')
+
+
+def _get_index(word_length):
+    """Returns the _LengthIndex of a word length, built on first use, or
+        None if the corpus has no word of that length"""
+    index = _indexes.get(word_length)
+    if index is None:
+        packed = _load_words().get(word_length)
+        if not packed:
+            return None
+        with _lock:
+            index = _indexes.get(word_length)
+            if index is None:
+                index = _indexes[word_length] = _LengthIndex(packed,
+                                                             word_length)
+    return index
+
+
+def get_hint(pattern, guessed):
+    """Returns the letter most likely to be in the word of a guess status.
+    Args:
+        :pattern <String>: the guess status, '_' for letters not revealed
+        :guessed <iterable of String>: the letters guessed so far
+    Returns:
+        :(letter, the number of corpus words matching the pattern).  The
+        letter is None if every letter has been guessed.  When no corpus word
+        matches, the letter is the most frequent one not guessed yet.
+    """
+    guessed = ''.join(sorted(set(guessed)))
+    key = (pattern, guessed)
+    hint = _hints.get(key)
+    if hint is None:
+        hint = _compute_hint(pattern, guessed)
+        _hints.set(key, hint)
+    return hint
+
+
+def _compute_hint(pattern, guessed):
+    index = _get_index(len(pattern))
+    candidates = index.candidates(pattern, guessed) if index else 0
+    count = _popcount(candidates)
+    if candidates:
+        hits = dict((letter, _popcount(candidates & bitset))
+                    for letter, bitset in index.contains.iteritems()
+                    if letter not in guessed)
+        if hits and max(hits.itervalues()):
+            # Prefer the earliest letter of the alphabet on a tie
+            return min(hits, key=lambda letter: (-hits[letter], letter)), count
+    for letter in LETTER_FREQUENCY:
+        if letter not in guessed:
+            return letter, count
+    return None, count